@@ -0,0 +1,424 @@
+"""Asynchronous versions of the upstream fetchers
+
+Every function here starts its HTTP requests and returns a ``Future`` right
+away.  A single-threaded ``Loop`` multiplexes the non-blocking sockets, so
+one process can keep hundreds of lookups in flight without a thread per
+request.  Responses go through the same parsers as the blocking API::
+
+    from earth import aio
+    from earth.weather import weatherbug
+    uv = aio.get_uv_index(zipcode='12207')
+    place = aio.geocode('Albany, NY')
+    forecast = aio.weatherbug(weatherbug.GetForecastByUSZipCode, '12207')
+    uv, place, forecast = aio.gather(uv, place, forecast)
+
+Python 2 has no asyncio so the loop is built on asyncore.  Only plain http
+urls are supported, which covers every upstream source.  Timeouts, retry
+backoff and instrumentation hooks are shared with
+``earth.core.transport.transport``.
+
+"""
+import asyncore
+import heapq
+import socket
+import sys
+import time
+from urlparse import urlsplit, urljoin
+
+from earth.core import USER_AGENT, RequestError
+from earth.core.config import conf
+from earth.core.transport import transport, Response, HTTPError, \
+    REDIRECTS, RETRY_STATUS, CHUNK_SIZE
+from earth import geo, sun
+from earth.air import uv, pollen
+from earth.weather import alerts, radar
+
+class Future(object):
+
+    """Result of an operation that completes later on the loop"""
+
+    def __init__(self):
+        self.done = False
+        self.value = self.error = None
+        self.callbacks = []
+
+    def set_result(self, value):
+        self._finish(value, None)
+    def set_error(self, error):
+        self._finish(None, error)
+    def _finish(self, value, error):
+        if self.done:
+            return
+        self.done, self.value, self.error = True, value, error
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_callback(self, callback):
+        """Calls callback(future) once done"""
+        if self.done:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+    def result(self):
+        if not self.done:
+            raise ValueError('Future is not done yet, run the loop first')
+        if self.error is not None:
+            raise self.error
+        return self.value
+    def then(self, fn):
+        """Future of fn(result); fn may itself return a Future"""
+        future = Future()
+        def chain(done):
+            if done.error is not None:
+                future.set_error(done.error)
+                return
+            try:
+                value = fn(done.value)
+            except Exception, e:
+                future.set_error(e)
+                return
+            if isinstance(value, Future):
+                value.add_callback(lambda f: _copy(f, future))
+            else:
+                future.set_result(value)
+        self.add_callback(chain)
+        return future
+
+def _copy(source, dest):
+    if source.error is not None:
+        dest.set_error(source.error)
+    else:
+        dest.set_result(source.value)
+
+def all_of(futures):
+    """Future of the list of results, failing with the first error"""
+    future = Future()
+    futures = list(futures)
+    results = [None] * len(futures)
+    remaining = [len(futures)]
+    def collect(i):
+        def done(f):
+            if f.error is not None:
+                future.set_error(f.error)
+                return
+            results[i] = f.value
+            remaining[0] -= 1
+            if not remaining[0]:
+                future.set_result(results)
+        return done
+    if not futures:
+        future.set_result(results)
+    for i,f in enumerate(futures):
+        f.add_callback(collect(i))
+    return future
+
+class _Request(asyncore.dispatcher):
+
+    """One HTTP/1.0 exchange on a non-blocking socket"""
+
+    def __init__(self, loop, url, data, callback):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self.loop = loop
+        self.callback = callback
+        self.chunks = []
+        self.start = time.time()
+        self.deadline = self.start + transport.connect_timeout + \
+                        transport.read_timeout
+        parts = urlsplit(url)
+        if parts.scheme != 'http':
+            raise ValueError('Only http urls are supported: %s' % url)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        lines = ['%s %s HTTP/1.0' % (data is None and 'GET' or 'POST', path),
+                 'Host: %s' % parts.netloc,
+                 'User-Agent: %s' % USER_AGENT]
+        if data is not None:
+            lines += ['Content-Type: application/x-www-form-urlencoded',
+                      'Content-Length: %d' % len(data)]
+        self.out = '\r\n'.join(lines) + '\r\n\r\n' + (data or '')
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((loop.resolve(parts.hostname), parts.port or 80))
+
+    def handle_connect(self):
+        pass
+    def writable(self):
+        return bool(self.out) or not self.connected
+    def handle_write(self):
+        self.out = self.out[self.send(self.out):]
+    def handle_read(self):
+        chunk = self.recv(CHUNK_SIZE)
+        if chunk:
+            self.chunks.append(chunk)
+    def handle_close(self):
+        self.finish(None)
+    def handle_error(self):
+        self.finish(sys.exc_info()[1])
+    def finish(self, error):
+        self.close()
+        if self.callback is not None:
+            callback, self.callback = self.callback, None
+            callback(''.join(self.chunks), error, time.time() - self.start)
+
+def _parse_response(url, raw):
+    head,sep,body = raw.partition('\r\n\r\n')
+    lines = head.split('\r\n')
+    status_line = lines[0].split(' ', 2)
+    if not sep or len(status_line) < 2 or not status_line[1].isdigit():
+        raise IOError('Bad HTTP response from %s' % url)
+    headers = {}
+    for line in lines[1:]:
+        if ':' not in line:
+            raise IOError('Bad HTTP header from %s: %r' % (url, line))
+        name,value = line.split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    return Response(url, int(status_line[1]), status_line[2:] and \
+                    status_line[2] or '', headers, body)
+
+class Loop(object):
+
+    """Event loop running many HTTP requests concurrently on one thread
+
+    At most ``limit`` sockets are open at once; further requests queue.
+    Name lookups block the loop, once per host: to keep them out of it,
+    call ``resolve`` for the hosts up front.
+    """
+
+    def __init__(self, limit=100):
+        self.limit = limit
+        self.map = {}
+        self.queue = []
+        self.timers = []
+        self.hosts = {}
+
+    def resolve(self, host):
+        """Cached name lookup, so only the first request per host blocks
+
+        Failed lookups raise socket.gaierror, an IOError.
+        """
+        if host not in self.hosts:
+            self.hosts[host] = socket.gethostbyname(host)
+        return self.hosts[host]
+
+    def call_later(self, delay, fn):
+        heapq.heappush(self.timers, (time.time() + delay, id(fn), fn))
+
+    def fetch(self, url, data=None):
+        """Future of the Response for url, POSTing data if given
+
+        Follows redirects and retries connection errors and 5xx answers
+        with the shared transport's backoff. Error statuses fail with
+        HTTPError, other errors (eg. a ValueError for an https url) fail
+        the future without a retry.
+        """
+        future = Future()
+        delays = transport.backoff.delays()
+        state = {'url': url, 'data': data, 'attempt': 0, 'redirects': 0}
+        def send():
+            state['attempt'] += 1
+            self.queue.append((state['url'], state['data'], received))
+        def retry(error):
+            for delay in delays:
+                self.call_later(delay, send)
+                return
+            future.set_error(error)
+        def received(raw, error, elapsed):
+            try:
+                handle(raw, error, elapsed)
+            except Exception, e:
+                future.set_error(e)
+        def handle(raw, error, elapsed):
+            method = state['data'] is None and 'GET' or 'POST'
+            response = None
+            if error is None:
+                try:
+                    response = _parse_response(state['url'], raw)
+                except IOError, e:
+                    error = e
+            transport.notify(method=method, url=state['url'],
+                             status=response and response.status or None,
+                             error=error, attempt=state['attempt'],
+                             elapsed=elapsed)
+            if error is not None:
+                if not isinstance(error, IOError):
+                    return future.set_error(error)
+                return retry(error)
+            if response.status in REDIRECTS and state['redirects'] < 5:
+                state['redirects'] += 1
+                state['url'] = urljoin(state['url'], response.headers['location'])
+                state['data'] = None
+                return send()
+            if response.status >= 400:
+                error = HTTPError(state['url'], response.status, response.reason)
+                if response.status in RETRY_STATUS:
+                    return retry(error)
+                return future.set_error(error)
+            future.set_result(response)
+        send()
+        return future
+
+    def _start(self):
+        while self.queue and len(self.map) < self.limit:
+            url,data,callback = self.queue.pop(0)
+            try:
+                _Request(self, url, data, callback)
+            except Exception, e:
+                callback('', e, 0)
+
+    def _expire(self):
+        now = time.time()
+        for request in self.map.values():
+            if now > request.deadline:
+                request.finish(socket.timeout('timed out'))
+        while self.timers and self.timers[0][0] <= now:
+            heapq.heappop(self.timers)[2]()
+
+    def run(self, until=None):
+        """Runs until the until future is done, or until idle"""
+        while not (until is not None and until.done):
+            self._start()
+            if not self.map and not self.queue:
+                if not self.timers:
+                    break
+                time.sleep(max(self.timers[0][0] - time.time(), 0))
+            else:
+                asyncore.loop(timeout=.05, map=self.map, count=1)
+            self._expire()
+
+default_loop = Loop()
+
+def gather(*futures, **kwargs):
+    """Runs the loop until every future is done, returns their results"""
+    future = all_of(futures)
+    (kwargs.get('loop') or default_loop).run(future)
+    return future.result()
+
+def _read(url, data=None, loop=None, error=RequestError):
+    """Future of the body at url, IOErrors logged and raised as error"""
+    future = Future()
+    def done(f):
+        if isinstance(f.error, IOError):
+            conf.log('warning','RequestError: %s'%f.error)
+            future.set_error(error(f.error))
+        elif f.error is not None:
+            future.set_error(f.error)
+        else:
+            future.set_result(f.value.data)
+    (loop or default_loop).fetch(url, data).add_callback(done)
+    return future
+
+def geocode(query, loop=None):
+    return _read(geo.geocode_url(query), loop=loop,
+                 error=lambda e: TypeError('Bad data from google')
+                 ).then(geo.parse_geocode)
+
+def get_uv_index(zipcode='', city_name='', state_code='', loop=None):
+    url = uv.uv_index_url(zipcode, city_name, state_code)
+    return _read(url, loop=loop).then(lambda data: uv.parse_uv_index(data, url))
+
+def get_pollen_counts(station_id, loop=None):
+    def follow(page):
+        link = pollen.report_link(page)
+        if link:
+            return _read(link, loop=loop)
+        return page
+    return _read(pollen.BASE_URL + pollen.ARGS % station_id, loop=loop
+                 ).then(follow).then(pollen.parse_pollen_counts)
+
+def get_cap_alert(region, loop=None):
+    return _read(alerts.CAP_URL % region, loop=loop).then(alerts.parse_cap_alert)
+
+def get_zone_alert(zone, loop=None):
+    return _read(alerts.ZONE_URL % zone, loop=loop).then(alerts.parse_zone_alert)
+
+def get_state_alert(state, loop=None):
+    return _read(alerts.STATE_URL % state.lower(), loop=loop
+                 ).then(alerts.parse_state_alert)
+
+def get_radar_report(station_id, radar_id='N0R', loop=None):
+    urls = radar.radar_urls(station_id, radar_id)
+    return all_of([_read(url, loop=loop) for url in urls]).then(
+        lambda pages: radar.parse_radar_report(pages[0], pages[1], urls[1]))
+
+def get_sun_report(**kwargs):
+    loop = kwargs.pop('loop', None)
+    url,data = sun.sun_report_request(**kwargs)
+    return _read(url, data, loop=loop).then(
+        lambda text: sun.parse_sun_report(text.splitlines(True), kwargs['year']))
+
+def weatherbug(call, *args, **kwargs):
+    """Runs any single request weatherbug Get* function, eg.
+    weatherbug(GetForecastByUSZipCode, '12207')"""
+    loop = kwargs.pop('loop', None)
+    return _read(call.url(*args, **kwargs), loop=loop).then(call.parse)
+
+def test(unit):
+    import threading
+    import BaseHTTPServer, SocketServer
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        failures = [503]
+        def do_GET(self):
+            if self.path == '/moved':
+                self.send_response(301)
+                self.send_header('Location', '/uv/moved')
+                self.end_headers()
+                return
+            if self.path == '/flaky' and self.failures:
+                self.send_error(self.failures.pop())
+                return
+            if self.path == '/missing':
+                self.send_error(404)
+                return
+            if self.path == '/garbled':
+                self.wfile.write('HTTP/1.0 200 OK\r\nno colon\r\n\r\nbody')
+                return
+            time.sleep(.2)
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write('<img alt="UVI %d">' % len(self.path))
+        def log_message(self, *args):
+            pass
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:%d' % server.server_port
+        backoff = transport.backoff.delay
+        transport.backoff.delay = 0
+        events = []
+        transport.hooks.append(events.append)
+        try:
+            test_loop = Loop()
+            futures = [_read(url + '/uv/' + 'x' * i, loop=test_loop
+                             ).then(uv.parse_uv_index) for i in range(20)]
+            start = time.time()
+            results = gather(*futures, loop=test_loop)
+            # Twenty 200ms responses served concurrently, not one by one
+            unit.assert_(time.time() - start < 2)
+            unit.assertEqual(results, [len('/uv/') + i for i in range(20)])
+            unit.assertEqual(gather(_read(url + '/moved', loop=test_loop),
+                                    loop=test_loop), ['<img alt="UVI 9">'])
+            unit.assertEqual(gather(test_loop.fetch(url + '/flaky'),
+                                    loop=test_loop)[0].status, 200)
+            unit.assertRaises(RequestError, gather,
+                              _read(url + '/missing', loop=test_loop),
+                              loop=test_loop)
+            unit.assert_(503 in [e['status'] for e in events])
+            unit.assertRaises(IOError, gather, test_loop.fetch(url + '/garbled'),
+                              loop=test_loop)
+            # Not worth retrying
+            del events[:]
+            unit.assertRaises(ValueError, gather,
+                              test_loop.fetch('https://127.0.0.1/'),
+                              loop=test_loop)
+            unit.assertEqual(len(events), 1)
+        finally:
+            transport.backoff.delay = backoff
+            transport.hooks.remove(events.append)
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -1,13 +1,6 @@
 import re
-import urllib
-import socket
-
-try:
-    from lxml import html
-except ImportError:
-    raise ImportError, "Missing dependency: lxml"
-
-#socket.setdefaulttimeout(5)
+from earth.core import require
+from earth.core.transport import transport
 
 BASE_URL = "http://www.aaaai.org/nab/index.cfm?"
 ARGS = "p=allergenreport&stationid=%s"
@@ -119,21 +112,23 @@ def find_page(station_id):
     
     """
     
+    html = transport.open(BASE_URL + ARGS % station_id).read()
+    link = report_link(html)
+    if link:
+        html = transport.open(link).read()
+    return html
+
+def report_link(html):
+    """Returns the url of the latest report linked from a station page"""
     link_re = re.compile(r'<a href="index.cfm\?(p=allergenreport&stationid=\d+&datecount=\d\d%2F\d\d%2F\d\d\d\d)">', re.DOTALL)
-    html = urllib.urlopen(BASE_URL + ARGS % station_id).read()
     search = link_re.search(html)
     if search:
-        html = urllib.urlopen(BASE_URL + search.groups()[0]).read()
-    return html
+        return BASE_URL + search.groups()[0]
 
-def get_pollen_counts(station_id):
-    """Retrieves pollen information from aaaai.org.
-    
-    Returns a list of integers containing the four different pollen counts:
-        - [Trees, Weeds, Grass, Mold]
-    """
-    
-    page_html = html.document_fromstring(find_page(station_id))
+def parse_pollen_counts(page):
+    """Scrapes the four pollen levels out of a report page"""
+    html = require('lxml.html')
+    page_html = html.document_fromstring(page)
     td_list = filter(lambda x:'133' in x.values(),
                      page_html.find_class('title'))
     name_re = re.compile(r'images/report(low|moderate|high|veryhigh)\.gif')
@@ -146,6 +141,14 @@ def get_pollen_counts(station_id):
             results.append('absent')
     return results
 
+def get_pollen_counts(station_id):
+    """Retrieves pollen information from aaaai.org.
+    
+    Returns a list of integers containing the four different pollen counts:
+        - [Trees, Weeds, Grass, Mold]
+    """
+    return parse_pollen_counts(find_page(station_id))
+
 def test(unit):
     for id in state2stations('MD'):
         for report in get_pollen_counts(id):
@@ -1,43 +1,48 @@
 import re
 import os
 
-from earth.core import HTTPRequest, RequestError, ScrapeError
+from earth.core import RequestError, ScrapeError
+from earth.core.transport import transport
 from urllib import urlencode
 from earth.core.config import conf
 from earth.geo import Location
 
 
-def get_uv_index(zipcode='', city_name='', state_code=''):
-    """Returns ultra violet index for a given city, state, or zipcode."""
+def uv_index_url(zipcode='', city_name='', state_code=''):
     if not zipcode and not (city_name and state_code):
         raise TypeError('Pass a zipcode or a city and state')
-    url = 'http://oaspub.epa.gov/enviro/uv_search?'+ urlencode(
+    return 'http://oaspub.epa.gov/enviro/uv_search?'+ urlencode(
         {'zipcode': zipcode,
          'city_name': city_name,
          'state_code': state_code})
-    try:
-        data = HTTPRequest().open(url).read()
-    except IOError, e:
-        conf.log('warning','RequestError: %s'%e)
-        raise RequestError(e)
+
+def parse_uv_index(data, url=''):
     match = re.search(r'alt="UVI (\d+)"', data)
     if match:
         return int(match.groups()[0])
     raise ScrapeError('Screen scrape failed: %s' % url)
 
+def get_uv_index(zipcode='', city_name='', state_code=''):
+    """Returns ultra violet index for a given city, state, or zipcode."""
+    url = uv_index_url(zipcode, city_name, state_code)
+    try:
+        data = transport.open(url).read()
+    except IOError, e:
+        conf.log('warning','RequestError: %s'%e)
+        raise RequestError(e)
+    return parse_uv_index(data, url)
+
 
 class UV(object):
     def __init__(self, query):
-        if conf.resource_exists('uv',query):
-            self.value = conf.load('uv',query)
-        else:
+        def fetch():
             loc = Location(query)
-            self.value =  get_uv_index(**{
+            return get_uv_index(**{
                 'zipcode': loc.postal_code,
                 'city_name': loc.locality,
                 'state_code': loc.state
             })
-            conf.dump('uv',self.value,query)
+        self.value = conf.cached('uv', query, fetch)
             
     def __repr__(self):
         return str(self.value)
@@ -1,15 +1,27 @@
+import sys
 import urllib
 import xml
 import time
-from datetime import datetime
-
+import threading
 try:
-    from SOAPpy import WSDL
+    from cStringIO import StringIO
 except ImportError:
-    raise ImportError, "Python Earth requires the SOAPpy library"
+    from StringIO import StringIO
+from datetime import datetime
 
 USER_AGENT = "Python Earth Library (http://launchpad.net/~python-earth/)"
 
+def require(name):
+    """Imports an optional dependency when it is first needed
+
+    Returns the named (sub)module, eg. require('lxml.objectify'), so modules
+    that only sometimes need lxml or SOAPpy do not pay for them at import.
+    """
+    try:
+        return __import__(name, {}, {}, ['__name__'])
+    except ImportError:
+        raise ImportError, "Missing dependency: %s" % name.split('.')[0]
+
 def force_unicode(s):
     """It's very ugly, but it works
     If anybody has a better idea to turn '\u0026' into u'&' please let me know
@@ -19,24 +31,72 @@ def force_unicode(s):
 
 class HTTPRequest(urllib.URLopener):
     
-    """Same as URLopener, but with custom user-agent string"""
+    """Same as URLopener, but with custom user-agent string
+
+    HTTP(S) urls go through the shared, pooled transport.
+    """
     
     def __init__(self):
         self.version = USER_AGENT
         urllib.URLopener.__init__(self)
 
+    def open(self, fullurl, data=None):
+        if fullurl.startswith('http://') or fullurl.startswith('https://'):
+            from earth.core.transport import transport
+            return transport.open(fullurl, data)
+        return urllib.URLopener.open(self, fullurl, data)
+
+# Methods parsed from each wsdl source, shared by every SoapClient
+_wsdl_methods = {}
+_wsdl_lock = threading.Lock()
+
+def wsdl_methods(source):
+    """Returns the {name: callinfo} methods described by a WSDL url or file
+
+    The raw description of a remote WSDL is kept in the store (app 'wsdl'),
+    so it is downloaded once per max_age and parsed once per process.  No
+    lock is held while it is downloaded.
+    """
+    _wsdl_lock.acquire()
+    try:
+        if source in _wsdl_methods:
+            return _wsdl_methods[source]
+    finally:
+        _wsdl_lock.release()
+    WSDL = require('SOAPpy.WSDL')
+    wsdl = source
+    if source.startswith('http://') or source.startswith('https://'):
+        from earth.core.config import conf
+        from earth.core.transport import transport
+        text = conf.cached('wsdl', urllib.quote(source, ''),
+                           lambda: transport.open(source).read())
+        wsdl = StringIO(text)
+    methods = WSDL.Proxy(wsdl).methods
+    _wsdl_lock.acquire()
+    try:
+        return _wsdl_methods.setdefault(source, methods)
+    finally:
+        _wsdl_lock.release()
+
 class SoapClient(object):
     
     """Special class to make soap requests but handle response errors.
     
-    If an error occurs, the request will be attempted two more times
-    before finally raising an error.  This was created because of the
-    sporadic instability of some SOAP API's.
+    Failed requests are retried following the backoff policy (by default
+    twice, a quarter and half a second apart) before finally raising an
+    error.  This was created because of the sporadic instability of some
+    SOAP API's.
+
+    Only the parsed WSDL is shared; every call gets its own SOAPProxy, so
+    calls from several threads run side by side.
     
     """
     
-    def __init__(self, wsdl_file):
-        self.client = WSDL.Proxy(wsdl_file)
+    def __init__(self, wsdl_file, backoff=None):
+        from earth.core.transport import Backoff
+        self.WSDL = require('SOAPpy.WSDL')
+        self.methods = wsdl_methods(wsdl_file)
+        self.backoff = backoff or Backoff(delay=.25)
 
     def __getattr__(self, name):
         def __call(*args, **kwargs):
@@ -44,21 +104,23 @@ class SoapClient(object):
 
             Raises AttributeError is method name is not found."""
 
-            if not self.client.methods.has_key(name):
+            if not self.methods.has_key(name):
                 raise AttributeError, name
-            callinfo = self.client.methods[name]
-            self.client.soapproxy.proxy = \
-                            WSDL.SOAPAddress(callinfo.location)
-            self.client.soapproxy.namespace = callinfo.namespace
-            self.client.soapproxy.soapaction = callinfo.soapAction
-            for x in range(3):
+            callinfo = self.methods[name]
+            delays = self.backoff.delays()
+            while 1:
+                proxy = self.WSDL.SOAPProxy(callinfo.location,
+                                            namespace=callinfo.namespace,
+                                            soapaction=callinfo.soapAction)
                 try:
-                    return self.client.soapproxy.__getattr__(name)(
-                                    *args, **kwargs)
-                except xml.sax._exceptions.SAXParseException, e:
-                    time.sleep(1)
-                    if x == 2:
-                        raise xml.sax._exceptions.SAXParseException, e
+                    return proxy.__getattr__(name)(*args, **kwargs)
+                except xml.sax._exceptions.SAXParseException:
+                    error = sys.exc_info()
+                for delay in delays:
+                    time.sleep(delay)
+                    break
+                else:
+                    raise error[0], error[1], error[2]
         return __call
 
 class RequestError(Exception):
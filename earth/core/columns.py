@@ -0,0 +1,163 @@
+"""Columnar snapshots of records for vectorized queries (needs NumPy)
+
+A ``ColumnBuilder`` collects records one at a time and builds ``Columns``:
+numeric fields become float64 masked arrays (masked where missing) and
+categorical fields integer codes into a sorted list of categories::
+
+    builder = ColumnBuilder(('temp_f',), ('station_id', 'state'))
+    for station in stations:
+        builder.add(station)
+    columns = builder.build()
+    hot = columns.filter(temp_f__gt=100, state='TX')
+    hot['station_id'], hot['temp_f']
+
+Lookups are field=value or field__op=value with op one of exact, gt, gte,
+lt, lte, in and isnull. Missing values never match a comparison.
+"""
+from earth.core import require
+
+OPERATORS = ('exact', 'gt', 'gte', 'lt', 'lte', 'in', 'isnull')
+
+class ColumnBuilder(object):
+
+    """Accumulates records into per-field lists"""
+
+    def __init__(self, numeric, categorical):
+        self.numeric = dict([(field, []) for field in numeric])
+        self.categorical = dict([(field, []) for field in categorical])
+
+    def add(self, record, **extra):
+        """Appends record (a mapping); extra values override its own"""
+        for field,values in self.numeric.items():
+            value = extra.get(field, record.get(field))
+            if isinstance(value, bool) or \
+               not isinstance(value, (int, long, float)):
+                value = None
+            values.append(value)
+        for field,values in self.categorical.items():
+            value = extra.get(field, record.get(field))
+            if value is not None:
+                value = str(value)
+            values.append(value)
+
+    def build(self):
+        numpy = require('numpy')
+        columns,categories = {},{}
+        for field,values in self.numeric.items():
+            mask = numpy.array([value is None for value in values], dtype=bool)
+            data = numpy.array([value or 0.0
+                                for value in values], dtype=numpy.float64)
+            columns[field] = numpy.ma.masked_array(data, mask)
+        for field,values in self.categorical.items():
+            names = sorted(set([value for value in values if value is not None]))
+            codes = dict([(name, i) for i,name in enumerate(names)])
+            columns[field] = numpy.array([codes.get(value, -1)
+                                          for value in values],
+                                         dtype=numpy.int32)
+            categories[field] = names
+        return Columns(columns, categories)
+
+class Columns(object):
+
+    """Typed columns of a snapshot, all the same length
+
+    Categorical columns hold codes into categories[field], -1 when missing.
+    """
+
+    def __init__(self, columns, categories):
+        self.columns = columns
+        self.categories = categories
+
+    def __len__(self):
+        for column in self.columns.values():
+            return len(column)
+        return 0
+
+    def __contains__(self, field):
+        return field in self.columns
+
+    def __getitem__(self, field):
+        """Masked array of a numeric field, object array (None when
+        missing) of the values of a categorical one"""
+        if field not in self.columns:
+            raise KeyError(field)
+        if field in self.categories:
+            numpy = require('numpy')
+            names = numpy.array(self.categories[field] + [None], dtype=object)
+            return names[self.columns[field]]
+        return self.columns[field]
+
+    def select(self, *fields):
+        """Dict of the named columns"""
+        return dict([(field, self[field]) for field in fields])
+
+    def _match(self, field, op, value):
+        numpy = require('numpy')
+        if field not in self.columns or op not in OPERATORS:
+            raise TypeError('Unknown lookup %s__%s' % (field, op))
+        column = self.columns[field]
+        if field in self.categories:
+            names = self.categories[field]
+            if op == 'isnull':
+                return (column == -1) == bool(value)
+            if op == 'exact':
+                value = [value]
+            elif op != 'in':
+                raise TypeError('%s is categorical, use exact or in' % field)
+            codes = [names.index(v) for v in map(str, value) if v in names]
+            return numpy.in1d(column, numpy.array(codes, dtype=numpy.int32))
+        missing = numpy.ma.getmaskarray(column)
+        if op == 'isnull':
+            return missing == bool(value)
+        data = column.data
+        if op == 'exact':
+            found = data == value
+        elif op == 'gt':
+            found = data > value
+        elif op == 'gte':
+            found = data >= value
+        elif op == 'lt':
+            found = data < value
+        elif op == 'lte':
+            found = data <= value
+        else:
+            found = numpy.in1d(data, numpy.array(value, dtype=numpy.float64))
+        return found & ~missing
+
+    def mask(self, **lookups):
+        """Boolean array of the rows matching every lookup"""
+        numpy = require('numpy')
+        keep = numpy.ones(len(self), dtype=bool)
+        for key,value in lookups.items():
+            field,op = key,'exact'
+            if '__' in key:
+                field,op = key.rsplit('__', 1)
+            keep &= self._match(field, op, value)
+        return keep
+
+    def filter(self, **lookups):
+        """Columns of the rows matching every lookup"""
+        keep = self.mask(**lookups)
+        return Columns(dict([(field, column[keep])
+                             for field,column in self.columns.items()]),
+                       self.categories)
+
+def test(unit):
+    records = [{'id': 'A', 'state': 'TX', 'temp': 101},
+               {'id': 'B', 'state': 'TX', 'temp': 88.5},
+               {'id': 'C', 'state': 'NY', 'temp': 'NA'},
+               {'id': 'D', 'temp': 104}]
+    builder = ColumnBuilder(('temp',), ('id', 'state'))
+    for record in records:
+        builder.add(record)
+    columns = builder.build()
+    unit.assertEqual(len(columns), 4)
+    unit.assertEqual(list(columns.filter(temp__gt=100)['id']), ['A', 'D'])
+    unit.assertEqual(list(columns.filter(temp__gt=100, state='TX')['id']),
+                     ['A'])
+    unit.assertEqual(list(columns.filter(temp__isnull=True)['id']), ['C'])
+    unit.assertEqual(list(columns.filter(state__in=['NY', 'CA'])['id']),
+                     ['C'])
+    unit.assertEqual(list(columns.filter(state__isnull=True)['id']), ['D'])
+    unit.assertEqual(list(columns['state']), ['TX', 'TX', 'NY', None])
+    unit.assertRaises(TypeError, columns.filter, wind__gt=1)
@@ -1,11 +1,12 @@
 from ConfigParser import ConfigParser, RawConfigParser
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
 import sys
 import os
+import time
+import threading
 import logging as log
+from Queue import Queue
+from earth.core.store import STORES, FileStore, LRUStore, FileLock, migrate
+from earth.core.transport import transport
 
 # Override this to customize the config file path
 CONFIG_FILE = ''
@@ -16,36 +17,85 @@ if not CONFIG_FILE:
     else:
         CONFIG_FILE = os.path.join(os.path.expanduser('~'),'.earth','.conf')
 
-if not os.path.isdir(os.path.dirname(CONFIG_FILE)):
-    os.makedirs(os.path.dirname(CONFIG_FILE))
-
 LOG_FILENAME = 'logging.out'
+# Background threads refreshing stale objects, see Config.refresh
+REFRESH_WORKERS = 2
+
+# Seconds a cached object stays fresh, per app. Override in the [max_age]
+# section of the config file. Apps not listed never expire.
+MINUTE, DAY = 60, 60 * 60 * 24
+MAX_AGES = {
+    'alerts': 10 * MINUTE,
+    'radar': 5 * MINUTE,
+    'uv': 60 * MINUTE,
+    'geo': 90 * DAY,
+    'sun': 365 * DAY,
+    'wsdl': 30 * DAY,
+}
 
 def create(**kwargs):
     config = RawConfigParser()
     config.add_section('earth')
     config.set('earth', 'data_root', kwargs.pop('earth.data_root', os.getcwd()))
     config.set('earth', 'log', kwargs.pop('earth.log', LOG_FILENAME))
+    config.set('earth', 'store', kwargs.pop('earth.store', 'sqlite'))
+    config.set('earth', 'cache_entries', kwargs.pop('earth.cache_entries', 1000))
+    config.set('earth', 'cache_bytes', kwargs.pop('earth.cache_bytes', 0))
     config.add_section('geo')
     config.set('geo', 'api_key', kwargs.pop('geo.api_key','ABQIAAAAtGw1MDAVWMO6QjAEb2-w_hQCULP4XOMyhPd8d_NrQQEO8sT8XBR4nl1tfW8GUiQ2uIWU8ASwZR6mXA7'))
     config.set('geo','sensor', kwargs.pop('geo.sensor','false'))
     config.set('geo','lat_lon',kwargs.pop('geo.lat_lon','40.479581,-117.773438'))
     config.set('geo','span',kwargs.pop('geo.span','11.1873,22.5'))
     config.set('geo','country', kwargs.pop('geo.country','us'))
+    config.add_section('observations')
+    config.set('observations', 'workers', kwargs.pop('observations.workers', 1))
+    config.set('observations', 'history_days',
+               kwargs.pop('observations.history_days', 30))
+    config.set('observations', 'hotlist', kwargs.pop('observations.hotlist', ''))
+    config.set('observations', 'hotlist_interval',
+               kwargs.pop('observations.hotlist_interval', 60))
+    config.set('observations', 'hotlist_workers',
+               kwargs.pop('observations.hotlist_workers', 4))
+    config.add_section('earthquake')
+    config.set('earthquake', 'preferred_networks',
+               kwargs.pop('earthquake.preferred_networks', 'us'))
+    config.add_section('max_age')
+    for app,age in MAX_AGES.items():
+        config.set('max_age', app, kwargs.pop('max_age.%s'%app, age))
     for k,v in kwargs.items():
         config.add_section(k)
         config.set(k,v)
+    if not os.path.isdir(os.path.dirname(CONFIG_FILE)):
+        os.makedirs(os.path.dirname(CONFIG_FILE))
     configfile = open(CONFIG_FILE, 'wb')
     config.write(configfile)
     configfile.close()
 
-if not os.path.isfile(CONFIG_FILE):
-    create()
-    
 class Config(object):
+
+    """Settings and storage for the whole library
+
+    Nothing is read or created on import; the config file (written with the
+    defaults if missing) is read on first use.
+
+    """
+
     def __init__(self):
-        self.conf = ConfigParser()
-        self.conf.read(CONFIG_FILE)
+        self._conf = None
+        self._store = None
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+        self._refresh_queue = Queue()
+        self._workers = []
+    @property
+    def conf(self):
+        if self._conf is None:
+            if not os.path.isfile(CONFIG_FILE):
+                create()
+            conf = ConfigParser()
+            conf.read(CONFIG_FILE)
+            self._conf = conf
+        return self._conf
     @property
     def data_root(self):
         if self.conf.has_option('earth','data_root'):
@@ -55,18 +105,136 @@ class Config(object):
         if self.conf.has_option('geo','api_key'):
             return self.conf.get('geo','api_key')
             
+    @property
+    def store(self):
+        """Storage backend picked by the earth.store option (default sqlite)
+
+        Fronted by an in-memory LRU tier bounded by the earth.cache_entries
+        and earth.cache_bytes options. Set cache_entries to 0 to disable it.
+        """
+        if self._store is None:
+            name = 'sqlite'
+            if self.conf.has_option('earth','store'):
+                name = self.conf.get('earth','store')
+            store = STORES[name](self.data_root)
+            entries,bytes = 1000,0
+            if self.conf.has_option('earth','cache_entries'):
+                entries = self.conf.getint('earth','cache_entries')
+            if self.conf.has_option('earth','cache_bytes'):
+                bytes = self.conf.getint('earth','cache_bytes')
+            if entries:
+                store = LRUStore(store, entries, bytes)
+            self._store = store
+        return self._store
+
     def resource_exists(self, app, name):
-        return os.path.isfile(os.path.join(self.data_root,app,'%s.obj'%name))
+        return self.store.exists(app, name)
     def dump(self, app, obj, id):
         #print '%s > %s %s'%(obj,app,id)
-        path = os.path.join(self.data_root, app, '%s.obj'%id)
-        if not os.path.isdir(os.path.dirname(path)):
-            self.mkdirs(app)
-        pickle.dump(obj, open(path, 'wb'), pickle.HIGHEST_PROTOCOL)
+        self.store.dump(app, obj, id)
     def load(self, app, id):
         #print '< %s %s'%(app,id)
-        if os.path.isfile(os.path.join(self.data_root,app,'%s.obj'%id)):
-            return pickle.load(open(os.path.join(self.data_root,app,'%s.obj'%id)))
+        return self.store.load(app, id)
+    def delete(self, app, id):
+        self.store.delete(app, id)
+    def keys(self, app, prefix=''):
+        return self.store.keys(app, prefix)
+    def scan(self, app, prefix=''):
+        return self.store.scan(app, prefix)
+    def max_age(self, app):
+        """Seconds objects of app stay fresh, None if they never expire"""
+        if self.conf.has_option('max_age', app):
+            return self.conf.getfloat('max_age', app)
+        return MAX_AGES.get(app)
+    def cached(self, app, id, fetch):
+        """Returns the stored object, calling fetch() only when needed
+
+        A missing object is fetched and stored before returning. A stale one
+        (older than max_age) is returned as is while a background thread
+        fetches a fresh copy, so readers of hot keys never wait on upstream.
+        """
+        entry = self.store.entry(app, id)
+        if entry is None:
+            obj = fetch()
+            self.dump(app, obj, id)
+            return obj
+        obj,fetched = entry
+        max_age = self.max_age(app)
+        if max_age is not None and time.time() - fetched > max_age:
+            self.refresh(app, id, fetch)
+        return obj
+    def refresh(self, app, id, fetch):
+        """Queues a fetch of a fresh copy for the background workers
+
+        At most REFRESH_WORKERS threads run the queue and a (app, id)
+        already queued or being fetched is not queued again.
+        """
+        key = (app, id)
+        self._refresh_lock.acquire()
+        try:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            if len(self._workers) < REFRESH_WORKERS:
+                thread = threading.Thread(target=self._refresh_worker)
+                thread.setDaemon(True)
+                thread.start()
+                self._workers.append(thread)
+        finally:
+            self._refresh_lock.release()
+        self._refresh_queue.put((app, id, fetch))
+    def _refresh_worker(self):
+        while 1:
+            app,id,fetch = self._refresh_queue.get()
+            try:
+                try:
+                    self.dump(app, fetch(), id)
+                except Exception, e:
+                    self.log('warning', 'Refresh of %s %s failed: %s'%(app, id, e))
+            finally:
+                self._refresh_lock.acquire()
+                self._refreshing.discard((app, id))
+                self._refresh_lock.release()
+    def begin(self):
+        """Starts a batch of writes, eg. for the length of a cron run"""
+        self.store.begin()
+    def commit(self):
+        self.store.commit()
+    def rollback(self):
+        """Ends a failed batch, throwing its writes away"""
+        self.store.rollback()
+    def ingest(self, path, parse):
+        """Calls parse() to store a download of transport.update() in a batch
+
+        When parse returns the batch is committed and the download confirmed.
+        When it raises the batch is rolled back and the download invalidated,
+        so the next update() downloads it again even if upstream has not
+        changed. Returns what parse returned.
+        """
+        self.begin()
+        try:
+            result = parse()
+        except:
+            self.rollback()
+            transport.invalidate(path)
+            raise
+        self.commit()
+        transport.confirm(path)
+        return result
+    def migrate(self, remove=False):
+        """Moves the legacy <data_root>/<app>/<id>.obj tree into the store"""
+        store = self.store
+        if isinstance(store, LRUStore):
+            store = store.store
+        if isinstance(store, FileStore):
+            return 0
+        return migrate(FileStore(self.data_root), self.store, remove)
+    def lock(self, name):
+        """Cross-process lock for name, eg. to keep one cron job per app
+
+        Different names lock independently so separate jobs run in parallel.
+        """
+        return FileLock(os.path.join(self.data_root, '.%s.lock'%name))
     def log(self,type,message):
         log.basicConfig(filename=os.path.join(conf.data_root,
                     self.conf.get('earth','log',LOG_FILENAME)),level=log.DEBUG)
@@ -76,10 +244,66 @@ class Config(object):
             os.makedirs(os.path.join(self.data_root,app))
     def get(self, *args, **kwargs):
         return self.conf.get(*args, **kwargs)
+    def getint(self, section, option, default=None):
+        """Integer option, default when it is not set"""
+        if self.conf.has_option(section, option):
+            return self.conf.getint(section, option)
+        return default
+    def getlist(self, section, option):
+        """Comma or whitespace separated option as a list, empty if not set"""
+        if self.conf.has_option(section, option):
+            return self.conf.get(section, option).replace(',', ' ').split()
+        return []
         
             
 conf = Config()
 
+def test(unit):
+    import tempfile, shutil
+    root = tempfile.mkdtemp()
+    try:
+        config = Config()
+        config._store = STORES['sqlite'](root)
+        calls = []
+        def fetch():
+            calls.append(1)
+            return len(calls)
+        unit.assertEqual(config.cached('alerts', 'ak.cap', fetch), 1)
+        unit.assertEqual(config.cached('alerts', 'ak.cap', fetch), 1)
+        unit.assertEqual(len(calls), 1)
+        # Stale entries are served immediately and refreshed behind the scenes
+        config.store.dump('alerts', 1, 'ak.cap', time.time() - DAY)
+        unit.assertEqual(config.cached('alerts', 'ak.cap', fetch), 1)
+        for i in range(100):
+            if config.load('alerts', 'ak.cap') == 2:
+                break
+            time.sleep(.05)
+        unit.assertEqual(config.load('alerts', 'ak.cap'), 2)
+        # Many stale keys share the workers, each is fetched once at a time
+        release = threading.Event()
+        fetched = []
+        def slow(id):
+            def fetch():
+                release.wait()
+                fetched.append(id)
+                return id
+            return fetch
+        for i in range(20):
+            config.store.dump('alerts', None, str(i), time.time() - DAY)
+        for i in range(20) * 2:
+            config.cached('alerts', str(i), slow(str(i)))
+        unit.assertEqual(len(config._workers), REFRESH_WORKERS)
+        release.set()
+        for i in range(100):
+            if not config._refreshing:
+                break
+            time.sleep(.05)
+        unit.assertEqual(sorted(fetched), sorted(map(str, range(20))))
+        unit.assertEqual(config.load('alerts', '19'), '19')
+        unit.assertEqual(config.max_age('earthquake'), None)
+    finally:
+        shutil.rmtree(root)
+
 if __name__ == '__main__':
     print dir(conf)
     print conf.data_root,conf.api_key
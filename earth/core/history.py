@@ -0,0 +1,191 @@
+"""Append-only time series of fixed-width records, one file per key
+
+Each file starts with a header naming its fields, followed by records of a
+timestamp and one double per field (NaN when missing), in time order. A
+time range is found by binary search and read with one sequential read::
+
+    history = History('/data/history', ('temp_f', 'wind_mph'), 30 * DAY)
+    history.append('KALB', time.time(), {'temp_f': 44, 'wind_mph': 9.2})
+    history.read('KALB', start, end, ['temp_f'])
+    # {'time': array('d', [...]), 'temp_f': array('d', [...])}
+
+Records older than the retention (in seconds) are dropped by rewriting the
+file, once the oldest is more than a tenth of the retention past it.
+"""
+import os
+import time
+import struct
+from array import array
+
+from earth.core.store import AtomicFile
+
+MAGIC = 'EHS1'
+NAN = float('nan')
+
+def _header(fields):
+    names = ','.join(fields)
+    return struct.pack('<4sH', MAGIC, len(names)) + names
+
+class History(object):
+
+    """Per key time series files under root"""
+
+    def __init__(self, root, fields, retention=None):
+        self.root = root
+        self.fields = tuple(fields)
+        self.retention = retention
+
+    def path(self, key):
+        return os.path.join(self.root, '%s.hist' % key)
+
+    def keys(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted([name[:-5] for name in os.listdir(self.root)
+                       if name.endswith('.hist')])
+
+    def _open(self, key, mode='rb'):
+        """(file, fields, header size, record struct), None if missing"""
+        try:
+            f = open(self.path(key), mode)
+        except IOError:
+            return None
+        magic,size = struct.unpack('<4sH', f.read(6))
+        if magic != MAGIC:
+            f.close()
+            raise IOError('Not a history file: %s' % self.path(key))
+        fields = tuple(f.read(size).split(','))
+        return f, fields, 6 + size, struct.Struct('<d%dd' % len(fields))
+
+    def _count(self, f, offset, record):
+        f.seek(0, 2)
+        return (f.tell() - offset) // record.size
+
+    def _time(self, f, offset, record, i):
+        f.seek(offset + i * record.size)
+        return struct.unpack('<d', f.read(8))[0]
+
+    def _bisect(self, f, offset, record, count, timestamp):
+        """Index of the first record at or after timestamp"""
+        lo,hi = 0,count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._time(f, offset, record, mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def append(self, key, timestamp, values):
+        """Adds a reading, False when it is not newer than the last one"""
+        opened = self._open(key, 'r+b')
+        if opened is None:
+            if not os.path.isdir(self.root):
+                os.makedirs(self.root)
+            f = AtomicFile(self.path(key))
+            f.write(_header(self.fields))
+            f.close()
+            opened = self._open(key, 'r+b')
+        f,fields,offset,record = opened
+        try:
+            count = self._count(f, offset, record)
+            if count and self._time(f, offset, record, count - 1) >= timestamp:
+                return False
+            row = []
+            for field in fields:
+                value = values.get(field)
+                if isinstance(value, bool) or \
+                   not isinstance(value, (int, long, float)):
+                    value = NAN
+                row.append(value)
+            # Drop a partial record left by an interrupted append
+            f.seek(offset + count * record.size)
+            f.truncate()
+            f.write(record.pack(timestamp, *row))
+            first = count and self._time(f, offset, record, 0)
+        finally:
+            f.close()
+        if self.retention and count and \
+           first < timestamp - self.retention * 1.1:
+            self.compact(key, timestamp)
+        return True
+
+    def compact(self, key, now=None):
+        """Rewrites the file of key without the records past retention"""
+        opened = self._open(key)
+        if opened is None or not self.retention:
+            return
+        f,fields,offset,record = opened
+        try:
+            count = self._count(f, offset, record)
+            first = self._bisect(f, offset, record, count,
+                                 (now or time.time()) - self.retention)
+            f.seek(offset + first * record.size)
+            data = f.read((count - first) * record.size)
+        finally:
+            f.close()
+        out = AtomicFile(self.path(key))
+        out.write(_header(fields))
+        out.write(data)
+        out.close()
+
+    def read(self, key, start=None, end=None, fields=None):
+        """Readings of key with start <= time < end as arrays of doubles
+
+        Returns {'time': array, field: array, ...} for the given fields
+        (default all), empty arrays when there are none.
+        """
+        fields = fields or self.fields
+        result = dict([(name, array('d')) for name in ('time',) + tuple(fields)])
+        opened = self._open(key)
+        if opened is None:
+            return result
+        f,stored,offset,record = opened
+        try:
+            count = self._count(f, offset, record)
+            lo,hi = 0,count
+            if start is not None:
+                lo = self._bisect(f, offset, record, count, start)
+            if end is not None:
+                hi = self._bisect(f, offset, record, count, end)
+            f.seek(offset + lo * record.size)
+            data = f.read(max(hi - lo, 0) * record.size)
+        finally:
+            f.close()
+        width = len(stored) + 1
+        values = array('d')
+        values.fromstring(data)
+        if struct.pack('<d', 1.0) != array('d', [1.0]).tostring():
+            values.byteswap()
+        columns = {'time': 0}
+        for i,name in enumerate(stored):
+            columns[name] = i + 1
+        for name in result:
+            if name in columns:
+                result[name] = values[columns[name]::width]
+            else:
+                result[name] = array('d', [NAN]) * (hi - lo)
+        return result
+
+def test(unit):
+    import tempfile, shutil
+    root = tempfile.mkdtemp()
+    try:
+        history = History(root, ('temp_f', 'wind_mph'), retention=100)
+        for t in range(10):
+            unit.assert_(history.append('KALB', 1000 + t * 10,
+                                        {'temp_f': 40 + t, 'wind_mph': 'NA'}))
+        unit.assert_(not history.append('KALB', 1000, {'temp_f': 1}))
+        data = history.read('KALB', 1020, 1050, ['temp_f', 'wind_mph'])
+        unit.assertEqual(list(data['time']), [1020, 1030, 1040])
+        unit.assertEqual(list(data['temp_f']), [42, 43, 44])
+        unit.assert_(data['wind_mph'][0] != data['wind_mph'][0])
+        unit.assertEqual(len(history.read('KALB')['time']), 10)
+        unit.assertEqual(len(history.read('KSTL')['time']), 0)
+        # Past 110% of the retention the oldest readings are dropped
+        history.append('KALB', 1150, {'temp_f': 50})
+        unit.assertEqual(list(history.read('KALB')['time']),
+                         [1050, 1060, 1070, 1080, 1090, 1150])
+        unit.assertEqual(history.keys(), ['KALB'])
+    finally:
+        shutil.rmtree(root)
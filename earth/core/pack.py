@@ -0,0 +1,133 @@
+"""Many pickled records in one file, read in one pass or one at a time
+
+A pack is written once, record by record, and replaced whole on the next
+write. The records are followed by an index of their offsets, so reading
+them all is one sequential read and reading one of them is one seek::
+
+    writer = PackWriter('/data/observations/stations.pack')
+    writer.add('KALB', {'temp_f': 44})
+    writer.close()
+    pack = PackFile('/data/observations/stations.pack')
+    pack.get('KALB')            # {'temp_f': 44}
+    for key,record in pack:     # in the order they were added
+        ...
+
+"""
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import struct
+
+from earth.core.store import AtomicFile
+
+MAGIC = 'EPK1'
+# Offset of the index and the magic again, at the very end of the file
+TRAILER = struct.Struct('<Q4s')
+
+class PackWriter(object):
+
+    """Writes a pack that only appears at path once closed"""
+
+    def __init__(self, path):
+        self.file = AtomicFile(path)
+        self.file.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.index = []
+
+    def add(self, key, record):
+        data = pickle.dumps(record, 2)
+        self.file.write(data)
+        self.index.append((key, self.offset, len(data)))
+        self.offset += len(data)
+
+    def close(self):
+        self.file.write(pickle.dumps(self.index, 2))
+        self.file.write(TRAILER.pack(self.offset, MAGIC))
+        self.file.close()
+
+    def discard(self):
+        self.file.discard()
+
+class PackFile(object):
+
+    """Reads a pack, raising IOError when it is missing or not a pack"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.file.seek(0, 2)
+            end = self.file.tell() - TRAILER.size
+            if end < len(MAGIC):
+                raise IOError('Not a pack file: %s' % path)
+            self.file.seek(end)
+            offset,magic = TRAILER.unpack(self.file.read(TRAILER.size))
+            if magic != MAGIC or not len(MAGIC) <= offset <= end:
+                raise IOError('Not a pack file: %s' % path)
+            self.file.seek(offset)
+            self.index = pickle.loads(self.file.read(end - offset))
+        except:
+            self.file.close()
+            raise
+        self.offsets = dict([(key, (offset, size))
+                             for key,offset,size in self.index])
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.offsets
+
+    def keys(self):
+        return [key for key,offset,size in self.index]
+
+    def get(self, key, default=None):
+        """The record of key, read with one seek"""
+        if key not in self.offsets:
+            return default
+        offset,size = self.offsets[key]
+        self.file.seek(offset)
+        return pickle.loads(self.file.read(size))
+
+    def __iter__(self):
+        """Generates (key, record) pairs reading the file front to back"""
+        self.file.seek(len(MAGIC))
+        for key,offset,size in self.index:
+            yield key, pickle.loads(self.file.read(size))
+
+    def close(self):
+        self.file.close()
+
+def test(unit):
+    import os, tempfile
+    fd,path = tempfile.mkstemp(suffix='.pack')
+    os.close(fd)
+    try:
+        writer = PackWriter(path)
+        for i in range(100):
+            writer.add('K%03d' % i, {'id': i, 'name': 'x' * i})
+        writer.close()
+        pack = PackFile(path)
+        try:
+            unit.assertEqual(len(pack), 100)
+            unit.assertEqual(pack.get('K042'), {'id': 42, 'name': 'x' * 42})
+            unit.assertEqual(pack.get('K100'), None)
+            unit.assert_('K099' in pack)
+            unit.assertEqual([key for key,record in pack],
+                             ['K%03d' % i for i in range(100)])
+            unit.assertEqual([record['id'] for key,record in pack], range(100))
+        finally:
+            pack.close()
+        # A discarded write leaves the previous pack in place
+        writer = PackWriter(path)
+        writer.add('K000', None)
+        writer.discard()
+        pack = PackFile(path)
+        unit.assertEqual(len(pack), 100)
+        pack.close()
+        for junk in ('', 'not a pack' * 10):
+            open(path, 'wb').write(junk)
+            unit.assertRaises(IOError, PackFile, path)
+    finally:
+        os.remove(path)
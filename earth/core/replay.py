@@ -0,0 +1,158 @@
+"""Record and replay the shared transport from fixture files
+
+With fixtures installed every request the shared transport makes is served
+from (or, when recording, saved to) one file per request, so fetchers and
+parsers can be tested and benchmarked without the network::
+
+    from earth.core import replay
+    replay.install('tests/fixtures')          # serve captured payloads
+    replay.install('tests/fixtures', True)    # capture live responses
+    replay.uninstall()
+
+A fixture is the request line followed by the response status line, its
+headers, a blank line and the raw body. Files live under <root>/<host>/ and
+are named after a digest of the method, url and (sorted) form data.
+"""
+import os
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+from urllib import urlencode
+from urlparse import urlsplit, parse_qsl
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from earth.core.store import AtomicFile
+from earth.core.transport import transport
+
+# Headers worth keeping in a fixture
+HEADERS = ('content-type', 'etag', 'last-modified', 'location')
+
+class FixtureResponse(object):
+
+    """Stands in for both the httplib response and its connection"""
+
+    will_close = True
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.fp = StringIO(body)
+
+    def read(self, *args):
+        return self.fp.read(*args)
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+    def getheaders(self):
+        return self.headers.items()
+    def close(self):
+        pass
+
+class Fixtures(object):
+
+    """Directory of captured responses, keyed by request"""
+
+    def __init__(self, root, record=False):
+        self.root = root
+        self.record = record
+
+    def path(self, method, url, data=None):
+        if data:
+            data = urlencode(sorted(parse_qsl(data, True)))
+        key = md5('%s %s\n%s' % (method, url, data or '')).hexdigest()
+        return os.path.join(self.root, urlsplit(url).hostname, key + '.http')
+
+    def load(self, method, url, data=None, headers=None):
+        """Returns the FixtureResponse for a request, IOError if missing
+
+        Conditional requests matching the fixture's validators get a 304.
+        """
+        path = self.path(method, url, data)
+        if not os.path.isfile(path):
+            raise IOError('No fixture for %s %s' % (method, url))
+        f = open(path, 'rb')
+        try:
+            f.readline()
+            status,reason = f.readline().rstrip('\r\n').split(' ', 1)
+            saved = {}
+            while 1:
+                line = f.readline().rstrip('\r\n')
+                if not line:
+                    break
+                name,value = line.split(': ', 1)
+                saved[name.lower()] = value
+            body = f.read()
+        finally:
+            f.close()
+        headers = headers or {}
+        for name,header in (('etag', 'If-None-Match'),
+                            ('last-modified', 'If-Modified-Since')):
+            if name in saved and headers.get(header) == saved[name]:
+                return FixtureResponse(304, 'Not Modified', saved, '')
+        return FixtureResponse(int(status), reason, saved, body)
+
+    def body(self, method, url, data=None):
+        """Raw payload of a fixture, for parsers that do no I/O"""
+        return self.load(method, url, data).read()
+
+    def save(self, method, url, data, response, body):
+        """Writes a fixture, returns a FixtureResponse for the caller to read
+
+        Not Modified answers are passed through without replacing a fixture.
+        """
+        headers = {}
+        for name in HEADERS:
+            value = response.getheader(name)
+            if value:
+                headers[name] = value
+        result = FixtureResponse(response.status, response.reason, headers,
+                                 body)
+        if response.status == 304:
+            return result
+        path = self.path(method, url, data)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = AtomicFile(path)
+        f.write('%s %s\n' % (method, url))
+        f.write('%s %s\n' % (response.status, response.reason))
+        for name,value in sorted(headers.items()):
+            f.write('%s: %s\n' % (name, value))
+        f.write('\n')
+        f.write(body)
+        f.close()
+        return result
+
+def install(root, record=False, client=None):
+    """Serves (or records) every request of client, the shared transport
+    by default, from fixture files under root"""
+    fixtures = Fixtures(root, record)
+    (client or transport).fixtures = fixtures
+    return fixtures
+
+def uninstall(client=None):
+    (client or transport).fixtures = None
+
+def test(unit):
+    import tempfile, shutil
+    from earth.core.transport import Transport, Backoff
+    root = tempfile.mkdtemp()
+    client = Transport(backoff=Backoff(0))
+    try:
+        fixtures = install(root, client=client)
+        unit.assertRaises(IOError, client.open, 'http://example.com/a')
+        response = FixtureResponse(200, 'OK', {'etag': '"1"'}, '')
+        fixtures.save('POST', 'http://example.com/a', 'b=2&a=1', response,
+                      'payload\n')
+        # Form data matches whatever order its fields are in
+        unit.assertEqual(client.open('http://example.com/a', 'a=1&b=2').read(),
+                         'payload\n')
+        unit.assertEqual(client.open('http://example.com/a', 'a=1&b=2',
+                         {'If-None-Match': '"1"'}).status, 304)
+        uninstall(client)
+        unit.assertEqual(client.fixtures, None)
+    finally:
+        shutil.rmtree(root)
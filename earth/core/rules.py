@@ -0,0 +1,258 @@
+"""Standing queries matched against records as they change
+
+A ``Rule`` is a set of lookups, written like the filters of
+``earth.core.columns``, and a target to deliver the matching records to::
+
+    index = RuleIndex()
+    gusts = index.add(Rule(alert, wind_gust_mph__gt=50, state='TX'))
+    fog = index.add(Rule(queue, visibility_mi__lt=1, near=(42.7, -73.8, 50)))
+    for rule in index.match(record):
+        rule.deliver(record)
+
+Callable targets are called with (rule, record), queues (anything with a
+put method) get (rule, record) tuples. near=(lat, lon, km) limits a rule to
+records whose latitude and longitude are within km of that point.
+
+Every field with a rule on it is indexed: comparisons by sorted thresholds,
+exact and in lookups by value, so matching a record costs a few bisections
+per field, not a test of every rule. Missing and non numeric values never
+match a comparison.
+"""
+import threading
+from bisect import bisect_left, bisect_right
+
+from earth.core.columns import OPERATORS
+from earth.core.spatial import haversine
+
+COMPARISONS = ('gt', 'gte', 'lt', 'lte')
+
+def _number(value):
+    return isinstance(value, (int, long, float)) and \
+        not isinstance(value, bool)
+
+class Rule(object):
+
+    """Lookups that deliver the records matching all of them to target"""
+
+    def __init__(self, target, near=None, **lookups):
+        if not lookups and near is None:
+            raise TypeError('A rule needs a lookup or near')
+        self.target = target
+        self.near = near
+        self.conditions = []
+        for key,value in lookups.items():
+            field,op = key,'exact'
+            if '__' in key:
+                field,op = key.rsplit('__', 1)
+            if op not in OPERATORS:
+                raise TypeError('Unknown lookup %s' % key)
+            if op in COMPARISONS and not _number(value):
+                raise TypeError('%s needs a number, not %r' % (key, value))
+            if op == 'in':
+                value = tuple(value)
+            self.conditions.append((field, op, value))
+
+    def test(self, record):
+        """Whether record matches, without an index"""
+        for field,op,value in self.conditions:
+            found = record.get(field)
+            if op == 'isnull':
+                if (found is None) != bool(value):
+                    return False
+            elif op == 'exact':
+                if found is None or found != value:
+                    return False
+            elif op == 'in':
+                if found is None or found not in value:
+                    return False
+            elif not _number(found):
+                return False
+            elif not {'gt': found > value, 'gte': found >= value,
+                      'lt': found < value, 'lte': found <= value}[op]:
+                return False
+        return self.within(record)
+
+    def within(self, record):
+        if self.near is None:
+            return True
+        lat,lon = record.get('latitude'), record.get('longitude')
+        if not _number(lat) or not _number(lon):
+            return False
+        return haversine(self.near[0], self.near[1], lat, lon) <= self.near[2]
+
+    def deliver(self, record):
+        if hasattr(self.target, 'put'):
+            self.target.put((self, record))
+        else:
+            self.target(self, record)
+
+    def __repr__(self):
+        lookups = ['%s__%s=%r' % condition for condition in self.conditions]
+        if self.near is not None:
+            lookups.append('near=%r' % (self.near,))
+        return '<Rule %s>' % ', '.join(lookups)
+
+class RuleIndex(object):
+
+    """Rules indexed by field, safe to share between threads"""
+
+    def __init__(self):
+        self.rules = []
+        # (field, op): ([threshold, ...], [rule, ...]) sorted by threshold
+        self.thresholds = {}
+        # (field, op): {value: [rule, ...]} for exact, in and isnull, the
+        # latter by whether the field is missing
+        self.values = {}
+        # Rules with only a near
+        self.anywhere = []
+        # Rule: sequence number, to match in the order rules were added
+        self.order = {}
+        self.added = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rules)
+
+    def add(self, rule):
+        """Indexes rule, returns it"""
+        self.lock.acquire()
+        try:
+            if rule in self.order:
+                return rule
+            self.rules.append(rule)
+            self.order[rule] = self.added
+            self.added += 1
+            if not rule.conditions:
+                self.anywhere.append(rule)
+            for field,op,value in rule.conditions:
+                if op in COMPARISONS:
+                    keys,rules = self.thresholds.setdefault((field, op),
+                                                            ([], []))
+                    i = bisect_right(keys, value)
+                    keys.insert(i, value)
+                    rules.insert(i, rule)
+                    continue
+                if op == 'isnull':
+                    values = [bool(value)]
+                elif op == 'in':
+                    values = set(value)
+                else:
+                    values = [value]
+                index = self.values.setdefault((field, op), {})
+                for value in values:
+                    index.setdefault(value, []).append(rule)
+        finally:
+            self.lock.release()
+        return rule
+
+    def remove(self, rule):
+        self.lock.acquire()
+        try:
+            if rule not in self.rules:
+                return
+            self.rules.remove(rule)
+            del self.order[rule]
+            if rule in self.anywhere:
+                self.anywhere.remove(rule)
+            for key,(keys,rules) in self.thresholds.items():
+                for i in reversed(range(len(rules))):
+                    if rules[i] is rule:
+                        del keys[i], rules[i]
+                if not rules:
+                    del self.thresholds[key]
+            for key,index in self.values.items():
+                for value,rules in index.items():
+                    rules[:] = [other for other in rules if other is not rule]
+                    if not rules:
+                        del index[value]
+                if not index:
+                    del self.values[key]
+        finally:
+            self.lock.release()
+
+    def match(self, record):
+        """The rules record matches, in the order they were added"""
+        self.lock.acquire()
+        try:
+            counts = {}
+            def hit(rules):
+                for rule in rules:
+                    counts[rule] = counts.get(rule, 0) + 1
+            for (field,op),(keys,rules) in self.thresholds.items():
+                value = record.get(field)
+                if not _number(value):
+                    continue
+                if op == 'gt':
+                    hit(rules[:bisect_left(keys, value)])
+                elif op == 'gte':
+                    hit(rules[:bisect_right(keys, value)])
+                elif op == 'lt':
+                    hit(rules[bisect_right(keys, value):])
+                else:
+                    hit(rules[bisect_left(keys, value):])
+            for (field,op),index in self.values.items():
+                value = record.get(field)
+                if op == 'isnull':
+                    value = value is None
+                elif value is None:
+                    continue
+                try:
+                    hit(index.get(value, ()))
+                except TypeError:
+                    # Unhashable values equal no lookup value
+                    pass
+            found = [rule for rule,count in counts.items()
+                     if count == len(rule.conditions)] + self.anywhere
+            found.sort(key=self.order.get)
+            return [rule for rule in found if rule.within(record)]
+        finally:
+            self.lock.release()
+
+def test(unit):
+    import random
+    from Queue import Queue
+    rnd = random.Random(0)
+    index = RuleIndex()
+    rules = []
+    for i in range(300):
+        lookups = {}
+        for field in rnd.sample(['wind', 'vis', 'temp'], rnd.randint(1, 2)):
+            op = rnd.choice(['gt', 'gte', 'lt', 'lte', 'exact', 'in',
+                             'isnull'])
+            value = rnd.randint(0, 10)
+            if op == 'in':
+                value = rnd.sample(range(10), 3)
+            elif op == 'isnull':
+                value = rnd.choice([True, False])
+            lookups['%s__%s' % (field, op)] = value
+        if rnd.random() < .2:
+            lookups['state'] = rnd.choice(['TX', 'NY'])
+        rules.append(index.add(Rule(None, **lookups)))
+    near = index.add(Rule(None, near=(42.7, -73.8, 50)))
+    rules.append(near)
+    for i in range(300):
+        record = {'state': rnd.choice(['TX', 'NY', None]),
+                  'latitude': rnd.uniform(42, 43), 'longitude': -73.8}
+        for field in ('wind', 'vis', 'temp'):
+            if rnd.random() < .8:
+                record[field] = rnd.choice([rnd.randint(0, 10),
+                                            rnd.uniform(0, 10), 'NA'])
+        unit.assertEqual(index.match(record),
+                         [rule for rule in rules if rule.test(record)])
+    for rule in rules[::2]:
+        index.remove(rule)
+    unit.assertEqual(len(index), len(rules[1::2]))
+    record = {'wind': 5, 'vis': 0.5, 'temp': 3, 'state': 'TX'}
+    unit.assertEqual(index.match(record),
+                     [rule for rule in rules[1::2] if rule.test(record)])
+    for rule in rules[1::2]:
+        index.remove(rule)
+    unit.assertEqual((index.thresholds, index.values), ({}, {}))
+    queue,calls = Queue(), []
+    Rule(queue, wind__gt=50).deliver({'wind': 60})
+    unit.assertEqual(queue.get_nowait()[1], {'wind': 60})
+    Rule(lambda rule, record: calls.append(record), wind=1).deliver({})
+    unit.assertEqual(calls, [{}])
+    unit.assertRaises(TypeError, Rule, None)
+    unit.assertRaises(TypeError, Rule, None, wind__gt='high')
+    unit.assertRaises(TypeError, Rule, None, wind__near=1)
@@ -0,0 +1,133 @@
+"""Nearest point queries on the sphere
+
+``SpatialIndex`` is a KD-tree over points on the unit sphere, so distances
+are right near the poles and across the antimeridian. It is built once from
+(key, lat, lon) tuples and pickles as a flat list, ready to be stored next
+to the snapshot it indexes::
+
+    index = SpatialIndex([('KALB', 42.75, -73.8), ('KSTL', 38.75, -90.37)])
+    index.nearest(42.65, -73.75)         # ('KALB', 11.6...)
+    index.k_nearest(40, -80, 2)          # [(key, km), ...] closest first
+    index.within(40, -80, 500)           # every point within 500 km
+
+"""
+from math import radians, sin, cos, asin, sqrt, pi
+from heapq import heappush, heapreplace
+
+# Mean radius in km
+EARTH_RADIUS = 6371.0088
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distance in km between two points in degrees"""
+    lat1,lon1,lat2,lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = sin((lat2 - lat1) / 2) ** 2 + \
+        cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(min(1, sqrt(a)))
+
+def _xyz(lat, lon):
+    lat,lon = radians(lat), radians(lon)
+    return cos(lat) * cos(lon), cos(lat) * sin(lon), sin(lat)
+
+def _chord2(km):
+    """Squared chord length on the unit sphere of an arc of km"""
+    return (2 * sin(min(km / EARTH_RADIUS, pi) / 2)) ** 2
+
+class SpatialIndex(object):
+
+    """Implicit KD-tree over 3D unit vectors
+
+    Nodes are (x, y, z, lat, lon, key) tuples ordered so that the middle of
+    every range splits it on one axis; the order is the whole tree.
+    """
+
+    def __init__(self, points=()):
+        nodes = []
+        for key,lat,lon in points:
+            if lat is None or lon is None:
+                continue
+            nodes.append(_xyz(lat, lon) + (lat, lon, key))
+        stack = [(0, len(nodes), 0)]
+        while stack:
+            lo,hi,axis = stack.pop()
+            if hi - lo < 2:
+                continue
+            nodes[lo:hi] = sorted(nodes[lo:hi], key=lambda node: node[axis])
+            mid = (lo + hi) // 2
+            stack.append((lo, mid, (axis + 1) % 3))
+            stack.append((mid + 1, hi, (axis + 1) % 3))
+        self.nodes = nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _search(self, lat, lon, k, limit):
+        """The k nodes closest to lat, lon within squared chord limit"""
+        nodes = self.nodes
+        x = _xyz(lat, lon)
+        found = []
+        stack = [(0, len(nodes), 0, 0.0)]
+        while stack:
+            lo,hi,axis,plane = stack.pop()
+            if len(found) == k:
+                limit = min(limit, -found[0][0])
+            if lo >= hi or plane > limit:
+                continue
+            mid = (lo + hi) // 2
+            node = nodes[mid]
+            d2 = (x[0] - node[0]) ** 2 + (x[1] - node[1]) ** 2 + \
+                 (x[2] - node[2]) ** 2
+            if d2 <= limit:
+                if len(found) < k:
+                    heappush(found, (-d2, mid))
+                elif d2 < -found[0][0]:
+                    heapreplace(found, (-d2, mid))
+            diff = x[axis] - node[axis]
+            near,far = (lo, mid), (mid + 1, hi)
+            if diff > 0:
+                near,far = far,near
+            # Pushed first so the near side is searched first
+            stack.append(far + ((axis + 1) % 3, diff * diff))
+            stack.append(near + ((axis + 1) % 3, 0.0))
+        found.sort(reverse=True)
+        return [(nodes[i][5], haversine(lat, lon, nodes[i][3], nodes[i][4]))
+                for d2,i in found]
+
+    def k_nearest(self, lat, lon, k):
+        """[(key, km), ...] of the k points closest to lat, lon"""
+        return self._search(lat, lon, k, 4.0)
+
+    def nearest(self, lat, lon):
+        """(key, km) of the point closest to lat, lon, None when empty"""
+        found = self._search(lat, lon, 1, 4.0)
+        if found:
+            return found[0]
+
+    def within(self, lat, lon, km):
+        """[(key, km), ...] of every point within km of lat, lon, closest
+        first"""
+        return self._search(lat, lon, len(self.nodes),
+                            _chord2(km) * (1 + 1e-9))
+
+def test(unit):
+    import random
+    rnd = random.Random(0)
+    points = [(i, rnd.uniform(-90, 90), rnd.uniform(-180, 180))
+              for i in range(2000)]
+    # Either side of the antimeridian and around the pole
+    points += [('east', 10, 179.9), ('west', 10, -179.9),
+               ('pole', 89.9, 0), ('other side', 89.9, 180)]
+    index = SpatialIndex(points)
+    def brute(lat, lon):
+        return sorted([(haversine(lat, lon, plat, plon), key)
+                       for key,plat,plon in points])
+    for lat,lon in [(10, 179.95), (89.95, 60), (-33.9, 151.2), (0, 0)]:
+        expected = brute(lat, lon)
+        unit.assertEqual(index.nearest(lat, lon)[0], expected[0][1])
+        unit.assertEqual([key for key,km in index.k_nearest(lat, lon, 5)],
+                         [key for km,key in expected[:5]])
+        inside = [key for km,key in expected if km <= 1000]
+        unit.assertEqual([key for key,km in index.within(lat, lon, 1000)],
+                         inside)
+    unit.assertEqual(index.nearest(10, -179.95)[0], 'west')
+    unit.assert_(index.nearest(10, 179.95)[1] < 6)
+    unit.assertEqual(SpatialIndex().nearest(0, 0), None)
@@ -0,0 +1,814 @@
+"""Storage backends for the objects cached under the data root
+
+Every backend maps an (app, id) pair to a pickled object.  The default is
+``SQLiteStore`` which keeps the whole cache in one indexed file instead of
+one ``<data_root>/<app>/<id>.obj`` pickle per object.  ``FileStore`` is the
+original layout and is kept for compatibility and as the source for
+``migrate``.
+
+Writes are safe to run from several processes at once: files are written
+to a temporary name and renamed into place, and SQLite runs in WAL mode so
+readers never block on (or see half of) a write.
+
+"""
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import os
+import sys
+import time
+import tempfile
+import threading
+import sqlite3
+from collections import OrderedDict
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+def replace(src, dst):
+    """Renames src over dst, atomically where the platform allows"""
+    if sys.platform.startswith('win') and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+class AtomicFile(object):
+
+    """File object that only appears at path once closed
+
+    Data is written to a temporary file in the same directory and renamed
+    over path by ``close``, so readers see either the old or the new file.
+    ``discard`` throws the temporary file away instead.
+
+    """
+
+    def __init__(self, path, mode='wb'):
+        self.path = path
+        dir = os.path.dirname(path)
+        if dir and not os.path.isdir(dir):
+            os.makedirs(dir)
+        fd,self.tmp = tempfile.mkstemp(prefix='.%s.'%os.path.basename(path),
+                                       dir=dir)
+        os.chmod(self.tmp, 0644)
+        self.file = os.fdopen(fd, mode)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+    def close(self):
+        self.file.close()
+        replace(self.tmp, self.path)
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+class FileLock(object):
+
+    """Advisory cross-process lock held on a lock file
+
+    Uses flock where available and is a no-op elsewhere.  Reentrant within a
+    single lock object.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.depth = 0
+
+    def acquire(self, blocking=True):
+        if self.depth:
+            self.depth += 1
+            return True
+        dir = os.path.dirname(self.path)
+        if dir and not os.path.isdir(dir):
+            os.makedirs(dir)
+        self.file = open(self.path, 'a')
+        if fcntl is not None:
+            flags = fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(self.file.fileno(), flags)
+            except IOError:
+                self.file.close()
+                self.file = None
+                return False
+        self.depth = 1
+        return True
+    def release(self):
+        self.depth -= 1
+        if not self.depth:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+class Store(object):
+
+    """Interface every storage backend implements.
+
+    ``begin``/``commit`` bracket a batch of writes (eg. a whole cron run).
+    Batches nest; only the outermost ``commit`` flushes.  ``rollback`` ends
+    a batch that failed instead, and the outermost batch then throws away
+    every write made since its ``begin``, where the backend can.
+
+    Every object is stored with the time it was fetched (seconds since the
+    epoch, defaulting to the time of the dump) which ``entry`` returns.
+
+    """
+
+    def exists(self, app, id):
+        raise NotImplementedError
+    def load(self, app, id):
+        entry = self.entry(app, id)
+        if entry is not None:
+            return entry[0]
+    def entry(self, app, id):
+        """Returns (obj, fetched) or None if nothing is stored"""
+        raise NotImplementedError
+    def fetched(self, app, id):
+        """Returns when the object was fetched without loading it, None if
+        nothing is stored"""
+        entry = self.entry(app, id)
+        if entry is not None:
+            return entry[1]
+    def dump(self, app, obj, id, fetched=None):
+        raise NotImplementedError
+    def delete(self, app, id):
+        raise NotImplementedError
+    def keys(self, app, prefix=''):
+        """Generates the ids stored for app, optionally by id prefix"""
+        raise NotImplementedError
+    def scan(self, app, prefix=''):
+        """Generates (id, obj) pairs for app, optionally by id prefix"""
+        for id in self.keys(app, prefix):
+            yield id, self.load(app, id)
+    def apps(self):
+        raise NotImplementedError
+    def begin(self):
+        pass
+    def commit(self):
+        pass
+    def rollback(self):
+        pass
+    def generation(self):
+        """Counter that changes whenever another store object publishes
+        writes, None when the backend can not tell"""
+        return None
+    def close(self):
+        pass
+
+class FileStore(Store):
+
+    """One pickle per object at <root>/<app>/<id>.obj
+
+    Each object is replaced atomically but batches are not transactions,
+    ``rollback`` keeps what was written.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        # Generation bumps of this object, which generation() leaves out
+        self.own = 0
+
+    def _bump(self):
+        path = os.path.join(self.root, '.generation')
+        lock = FileLock(path + '.lock')
+        lock.acquire()
+        try:
+            value = self._generation() + 1
+            f = AtomicFile(path, 'w')
+            f.write(str(value))
+            f.close()
+            self.own += 1
+        finally:
+            lock.release()
+    def _generation(self):
+        try:
+            return int(open(os.path.join(self.root, '.generation')).read())
+        except (IOError, ValueError):
+            return 0
+    def generation(self):
+        return self._generation() - self.own
+
+    def path(self, app, id):
+        return os.path.join(self.root, app, '%s.obj'%id)
+    def exists(self, app, id):
+        return os.path.isfile(self.path(app, id))
+    def entry(self, app, id):
+        if self.exists(app, id):
+            f = open(self.path(app, id), 'rb')
+            try:
+                return pickle.load(f), os.fstat(f.fileno()).st_mtime
+            finally:
+                f.close()
+    def fetched(self, app, id):
+        try:
+            return os.path.getmtime(self.path(app, id))
+        except OSError:
+            return None
+    def dump(self, app, obj, id, fetched=None):
+        path = self.path(app, id)
+        f = AtomicFile(path)
+        try:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        except:
+            f.discard()
+            raise
+        f.close()
+        # The file mtime doubles as the fetch time
+        if fetched is not None:
+            os.utime(path, (fetched, fetched))
+        self._bump()
+    def delete(self, app, id):
+        if self.exists(app, id):
+            os.remove(self.path(app, id))
+            self._bump()
+    def keys(self, app, prefix=''):
+        dir = os.path.join(self.root, app)
+        if not os.path.isdir(dir):
+            return
+        for file in sorted(os.listdir(dir)):
+            if file.endswith('.obj') and file.startswith(prefix):
+                yield os.path.splitext(file)[0]
+    def apps(self):
+        if not os.path.isdir(self.root):
+            return []
+        return [app for app in sorted(os.listdir(self.root)) \
+                if os.path.isdir(os.path.join(self.root, app))]
+
+def _text(s):
+    """sqlite wants unicode, ids may be utf-8 encoded strings"""
+    if isinstance(s, unicode):
+        return s
+    return str(s).decode('utf-8', 'replace')
+
+class SQLiteStore(Store):
+
+    """All objects in a single SQLite file, indexed by (app, id)
+
+    Each thread gets its own connection, as sqlite3 requires.  Writes outside
+    a batch commit one by one.  A batch never holds the database lock for
+    long: its writes are buffered and moved to the ``staged`` table every
+    ``batch_size`` rows, each move a short transaction of its own, and the
+    outermost ``commit`` publishes them all to ``objects`` in one last
+    transaction, so readers never see part of a batch.  ``rollback`` only
+    drops the staged rows.  Every publish bumps the ``generation`` row.
+
+    """
+
+    timeout = 60
+    batch_size = 500
+    # Staged rows this old were left by a batch that died with its process
+    stale = 86400
+
+    SCHEMA = ["""CREATE TABLE IF NOT EXISTS objects (
+        app TEXT NOT NULL,
+        id TEXT NOT NULL,
+        data BLOB NOT NULL,
+        fetched REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (app, id)
+    )""", """CREATE TABLE IF NOT EXISTS staged (
+        batch TEXT NOT NULL,
+        app TEXT NOT NULL,
+        id TEXT NOT NULL,
+        data BLOB,
+        fetched REAL NOT NULL DEFAULT 0,
+        started REAL NOT NULL,
+        PRIMARY KEY (batch, app, id)
+    )""", """CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )""", "INSERT OR IGNORE INTO meta VALUES ('generation', 0)"]
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        # Generation bumps of this object, which generation() leaves out
+        self.own = 0
+        self.own_lock = threading.Lock()
+
+    @property
+    def db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            db = sqlite3.connect(self.path, timeout=self.timeout)
+            db.text_factory = str
+            db.execute('PRAGMA journal_mode=WAL')
+            for sql in self.SCHEMA:
+                db.execute(sql)
+            columns = [row[1] for row in db.execute('PRAGMA table_info(objects)')]
+            if 'fetched' not in columns:
+                db.execute('ALTER TABLE objects ADD COLUMN '
+                           'fetched REAL NOT NULL DEFAULT 0')
+            db.commit()
+            self.local.db, self.local.depth, self.local.failed = db, 0, False
+            self._reset()
+        return db
+
+    def _reset(self):
+        # Rows of the thread's batch not yet moved to staged, keyed by
+        # (app, id), and the keys that were; data is None for a deletion
+        self.local.batch, self.local.pending, self.local.staged = None, {}, set()
+
+    def _row(self, app, id, columns='data, fetched'):
+        """The stored row as this thread sees it, None when there is none"""
+        db = self.db
+        key = (_text(app), _text(id))
+        if self.local.depth:
+            row = self.local.pending.get(key)
+            if row is None and key in self.local.staged:
+                row = db.execute('SELECT data, fetched FROM staged '
+                                 'WHERE batch=? AND app=? AND id=?',
+                                 (self.local.batch,) + key).fetchone()
+            if row is not None:
+                if row[0] is None:
+                    return None
+                return row
+        return db.execute('SELECT %s FROM objects WHERE app=? AND id=?'%columns,
+                          key).fetchone()
+    def _write(self, app, id, data, fetched):
+        db = self.db
+        key = (_text(app), _text(id))
+        if self.local.depth:
+            self.local.pending[key] = (data, fetched)
+            if len(self.local.pending) >= self.batch_size:
+                self._flush()
+            return
+        try:
+            if data is None:
+                db.execute('DELETE FROM objects WHERE app=? AND id=?', key)
+            else:
+                db.execute('INSERT OR REPLACE INTO objects '
+                           '(app, id, data, fetched) VALUES (?, ?, ?, ?)',
+                           key + (data, fetched))
+            self._publish()
+        except:
+            db.rollback()
+            raise
+    def _flush(self):
+        """Moves the pending writes of the batch to staged"""
+        pending = self.local.pending
+        if not pending:
+            return
+        db = self.db
+        try:
+            db.executemany('INSERT OR REPLACE INTO staged '
+                           '(batch, app, id, data, fetched, started) '
+                           'VALUES (?, ?, ?, ?, ?, ?)',
+                           [(self.local.batch,) + key + row + (time.time(),)
+                            for key,row in pending.iteritems()])
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        self.local.staged.update(pending)
+        self.local.pending = {}
+    def _publish(self):
+        """Bumps the generation and commits the open transaction"""
+        self.db.execute("UPDATE meta SET value=value+1 WHERE key='generation'")
+        self.db.commit()
+        self.own_lock.acquire()
+        try:
+            self.own += 1
+        finally:
+            self.own_lock.release()
+    def generation(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key='generation'")
+        return row.fetchone()[0] - self.own
+
+    def exists(self, app, id):
+        return self._row(app, id, 'fetched') is not None
+    def entry(self, app, id):
+        row = self._row(app, id)
+        if row is not None:
+            return pickle.loads(str(row[0])), row[1]
+    def fetched(self, app, id):
+        row = self._row(app, id, 'fetched')
+        if row is not None:
+            return row[-1]
+    def dump(self, app, obj, id, fetched=None):
+        if fetched is None:
+            fetched = time.time()
+        data = sqlite3.Binary(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+        self._write(app, id, data, fetched)
+    def delete(self, app, id):
+        self._write(app, id, None, 0)
+    def _select(self, columns, app, prefix):
+        where = 'app=?'
+        args = [_text(app)]
+        if prefix:
+            # Range on the primary key so prefix scans use the index
+            prefix = _text(prefix)
+            where += ' AND id>=? AND id<?'
+            args += [prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)]
+        db = self.db
+        if not self.local.depth or \
+           not (self.local.pending or self.local.staged):
+            return db.execute('SELECT %s FROM objects WHERE %s ORDER BY id'%
+                              (columns, where), args)
+        # Inside a batch its staged rows override the published ones
+        self._flush()
+        return db.execute('SELECT %(c)s FROM objects WHERE %(w)s AND NOT EXISTS '
+                          '(SELECT 1 FROM staged WHERE batch=? AND '
+                          'staged.app=objects.app AND staged.id=objects.id) '
+                          'UNION ALL SELECT %(c)s FROM staged WHERE batch=? '
+                          'AND %(w)s AND data IS NOT NULL ORDER BY id'%
+                          {'c': columns, 'w': where},
+                          args + [self.local.batch] * 2 + args)
+    def keys(self, app, prefix=''):
+        for row in self._select('id', app, prefix):
+            yield row[0]
+    def scan(self, app, prefix=''):
+        for id,data in self._select('id, data', app, prefix):
+            yield id, pickle.loads(str(data))
+    def apps(self):
+        return sorted(set(row[0] for row in \
+                          self.db.execute('SELECT DISTINCT app FROM objects')) |
+                      set(key[0] for key,row in self.local.pending.iteritems() \
+                          if row[0] is not None) |
+                      set(row[0] for row in \
+                          self.db.execute('SELECT DISTINCT app FROM staged '
+                                          'WHERE batch=? AND data IS NOT NULL',
+                                          (self.local.batch,))))
+    def begin(self):
+        db = self.db
+        if not self.local.depth:
+            db.execute('DELETE FROM staged WHERE started<?',
+                       (time.time() - self.stale,))
+            db.commit()
+            self.local.batch = '%d.%s'%(os.getpid(), os.urandom(8).encode('hex'))
+        self.local.depth += 1
+    def commit(self):
+        self._end(False)
+    def rollback(self):
+        self._end(True)
+    def _end(self, failed):
+        db = self.db
+        self.local.failed = self.local.failed or failed
+        self.local.depth = max(self.local.depth - 1, 0)
+        if self.local.depth or self.local.batch is None:
+            return
+        batch = (self.local.batch,)
+        try:
+            # A nested batch that failed fails the whole batch
+            if self.local.failed:
+                if self.local.staged:
+                    db.execute('DELETE FROM staged WHERE batch=?', batch)
+                    db.commit()
+            elif self.local.pending or self.local.staged:
+                if self.local.staged:
+                    db.execute('INSERT OR REPLACE INTO objects '
+                               '(app, id, data, fetched) '
+                               'SELECT app, id, data, fetched FROM staged '
+                               'WHERE batch=? AND data IS NOT NULL', batch)
+                    db.execute('DELETE FROM objects WHERE EXISTS '
+                               '(SELECT 1 FROM staged WHERE batch=? AND '
+                               'staged.app=objects.app AND '
+                               'staged.id=objects.id AND staged.data IS NULL)', batch)
+                    db.execute('DELETE FROM staged WHERE batch=?', batch)
+                pending = self.local.pending.items()
+                db.executemany('INSERT OR REPLACE INTO objects '
+                               '(app, id, data, fetched) VALUES (?, ?, ?, ?)',
+                               [key + row for key,row in pending \
+                                if row[0] is not None])
+                db.executemany('DELETE FROM objects WHERE app=? AND id=?',
+                               [key for key,row in pending if row[0] is None])
+                self._publish()
+        except:
+            db.rollback()
+            raise
+        finally:
+            self.local.failed = False
+            self._reset()
+    def close(self):
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.commit()
+            db.close()
+            self.local.db = None
+
+class LRUStore(Store):
+
+    """Bounded in-process memory tier in front of another store
+
+    Keeps the most recently used entries in memory, bounded by entry count
+    and optionally by their pickled size in bytes.  Dumps write through to
+    the backing store.  ``hits`` and ``misses`` count memory lookups.
+
+    Hits are served from memory without touching the backing store.  Other
+    processes write to it too, so at most every ``interval`` seconds its
+    ``generation`` is checked and the whole tier dropped once it changed.
+
+    Writes made during a batch (eg. a whole cron run) go to the backing
+    store only, so bulk writes do not push out the entries in use, and
+    reads inside the batch go there as well.
+
+    Cached objects are shared between callers, so treat them as read only
+    and copy them before changing them.
+
+    """
+
+    interval = 1.0
+
+    def __init__(self, store, max_entries=1000, max_bytes=0):
+        self.store = store
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+        # Generation of the backing store when last checked
+        self.seen = store.generation()
+        self.checked = time.time()
+        # Per thread batch depth and the keys written during the batch
+        self.local = threading.local()
+
+    def _size(self, obj):
+        if self.max_bytes:
+            return len(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+        return 0
+    def _put(self, key, entry):
+        size = self._size(entry[0])
+        self.lock.acquire()
+        try:
+            self._pop(key)
+            self.entries[key] = entry + (size,)
+            self.bytes += size
+            while self.entries and (len(self.entries) > self.max_entries or \
+                  (self.max_bytes and self.bytes > self.max_bytes)):
+                self.bytes -= self.entries.popitem(last=False)[1][2]
+        finally:
+            self.lock.release()
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+        return entry
+    def _discard(self, keys):
+        self.lock.acquire()
+        try:
+            for key in keys:
+                self._pop(key)
+        finally:
+            self.lock.release()
+    def _check(self):
+        """Drops every entry once the backing store changed elsewhere"""
+        self.checked = time.time()
+        generation = self.store.generation()
+        if generation is None or generation != self.seen:
+            self.clear()
+            self.seen = generation
+    def _batch(self):
+        return getattr(self.local, 'depth', 0)
+
+    def exists(self, app, id):
+        if not self._batch():
+            if time.time() - self.checked >= self.interval:
+                self._check()
+            if (app, id) in self.entries:
+                return True
+        return self.store.exists(app, id)
+    def entry(self, app, id):
+        if getattr(self.local, 'depth', 0):
+            return self.store.entry(app, id)
+        if time.time() - self.checked >= self.interval:
+            self._check()
+        key = (app, id)
+        self.lock.acquire()
+        try:
+            # Moves a hit to the recent end
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.hits += 1
+                self.entries[key] = entry
+                return entry[:2]
+            self.misses += 1
+        finally:
+            self.lock.release()
+        entry = self.store.entry(app, id)
+        if entry is not None:
+            self._put(key, entry)
+        return entry
+    def dump(self, app, obj, id, fetched=None):
+        if fetched is None:
+            fetched = time.time()
+        self.store.dump(app, obj, id, fetched)
+        if self._batch():
+            self._discard([(app, id)])
+            self.local.written.add((app, id))
+        else:
+            self._put((app, id), (obj, fetched))
+    def delete(self, app, id):
+        self._discard([(app, id)])
+        self.store.delete(app, id)
+        if self._batch():
+            self.local.written.add((app, id))
+    def keys(self, app, prefix=''):
+        return self.store.keys(app, prefix)
+    def scan(self, app, prefix=''):
+        return self.store.scan(app, prefix)
+    def apps(self):
+        return self.store.apps()
+    def begin(self):
+        if not self._batch():
+            self.local.depth, self.local.written = 0, set()
+        self.local.depth += 1
+        self.store.begin()
+    def commit(self):
+        written = self._end()
+        self.store.commit()
+        # Other threads may have cached the old objects meanwhile
+        if written:
+            self._discard(written)
+    def rollback(self):
+        written = self._end()
+        self.store.rollback()
+        if written:
+            self._discard(written)
+    def _end(self):
+        """Keys written by the batch, once the outermost one ends"""
+        self.local.depth = max(self._batch() - 1, 0)
+        if not self.local.depth:
+            written = getattr(self.local, 'written', ())
+            self.local.written = set()
+            return written
+    def generation(self):
+        return self.store.generation()
+    def close(self):
+        self.clear()
+        self.store.close()
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.bytes = 0
+        finally:
+            self.lock.release()
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries), 'bytes': self.bytes}
+
+STORES = {
+    'sqlite': lambda root: SQLiteStore(os.path.join(root, 'earth.db')),
+    'file': FileStore,
+}
+
+def migrate(source, dest, remove=False):
+    """Copies every object from one store into another in a single batch
+
+    Typically used to move an existing .obj tree into the SQLite store::
+
+        migrate(FileStore(conf.data_root), conf.store)
+
+    Returns the number of objects copied.
+    """
+    count = 0
+    dest.begin()
+    try:
+        for app in source.apps():
+            for id in source.keys(app):
+                obj,fetched = source.entry(app, id)
+                dest.dump(app, obj, id, fetched)
+                count += 1
+    except:
+        dest.rollback()
+        raise
+    dest.commit()
+    if remove:
+        for app in source.apps():
+            for id in list(source.keys(app)):
+                source.delete(app, id)
+    return count
+
+def test(unit):
+    import tempfile, shutil
+    root = tempfile.mkdtemp()
+    try:
+        files = FileStore(root)
+        files.dump('geo', {'address': 'Albany, NY, USA'}, 'Albany%2C+NY')
+        files.dump('earthquake', {'id': 'ak1'}, 'ak1')
+        files.dump('earthquake', {'id': 'ak2'}, 'ak2')
+        files.dump('earthquake', {'id': 'us1'}, 'us1')
+        db = STORES['sqlite'](root)
+        unit.assertEqual(migrate(files, db), 4)
+        unit.assertEqual(db.load('geo', 'Albany%2C+NY'),
+                         {'address': 'Albany, NY, USA'})
+        unit.assertEqual(list(db.keys('earthquake', 'ak')), ['ak1', 'ak2'])
+        unit.assertEqual(dict(db.scan('earthquake')),
+                         dict(files.scan('earthquake')))
+        db.begin()
+        db.dump('earthquake', {'id': 'us1', 'version': '2'}, 'us1')
+        db.delete('earthquake', 'ak1')
+        db.commit()
+        unit.assert_(not db.exists('earthquake', 'ak1'))
+        unit.assertEqual(db.load('earthquake', 'us1')['version'], '2')
+        unit.assertEqual(db.load('earthquake', 'missing'), None)
+        # A long batch lets other connections write and hides its own
+        # writes from them until it commits
+        db.batch_size = 2
+        db.begin()
+        for i in range(5):
+            db.dump('earthquake', {'id': 'nc%d'%i}, 'nc%d'%i)
+        db.delete('earthquake', 'ak2')
+        writer = STORES['sqlite'](root)
+        writer.timeout = .1
+        writer.dump('geo', {'address': 'Troy'}, 'Troy')
+        unit.assert_(not writer.exists('earthquake', 'nc0'))
+        unit.assertEqual(db.load('earthquake', 'nc0'), {'id': 'nc0'})
+        unit.assertEqual(list(db.keys('earthquake')),
+                         ['nc0', 'nc1', 'nc2', 'nc3', 'nc4', 'us1'])
+        db.commit()
+        unit.assertEqual(list(writer.keys('earthquake')),
+                         ['nc0', 'nc1', 'nc2', 'nc3', 'nc4', 'us1'])
+        unit.assertEqual(db.db.execute('SELECT COUNT(*) FROM staged')
+                         .fetchone()[0], 0)
+        db.begin()
+        db.dump('earthquake', {'id': 'nc5'}, 'nc5')
+        db.dump('earthquake', {'id': 'nc6'}, 'nc6')
+        db.rollback()
+        unit.assert_(not db.exists('earthquake', 'nc5'))
+        for i in range(5):
+            db.delete('earthquake', 'nc%d'%i)
+        writer.delete('geo', 'Troy')
+        del db.batch_size
+        db.dump('alerts', {}, 'ak.cap', 1000.0)
+        unit.assertEqual(db.entry('alerts', 'ak.cap'), ({}, 1000.0))
+        lru = LRUStore(db, max_entries=2)
+        lru.dump('geo', {'address': 'Troy, NY, USA'}, 'Troy%2C+NY')
+        unit.assertEqual(db.load('geo', 'Troy%2C+NY'),
+                         {'address': 'Troy, NY, USA'})
+        lru.load('geo', 'Troy%2C+NY')
+        lru.load('geo', 'Albany%2C+NY')
+        lru.load('earthquake', 'us1')
+        unit.assertEqual((lru.hits, lru.misses), (1, 2))
+        unit.assertEqual(len(lru.entries), 2)
+        lru.load('geo', 'Troy%2C+NY')
+        unit.assertEqual(lru.misses, 3)
+        # Hits never reach the backing store, batch writes never enter the
+        # memory tier
+        db.entry = None
+        unit.assertEqual(lru.load('geo', 'Troy%2C+NY'),
+                         {'address': 'Troy, NY, USA'})
+        unit.assert_(lru.exists('geo', 'Troy%2C+NY'))
+        del db.entry
+        lru.begin()
+        lru.dump('earthquake', {'id': 'hv1'}, 'hv1')
+        unit.assertEqual(lru.load('earthquake', 'hv1'), {'id': 'hv1'})
+        lru.commit()
+        unit.assert_(('earthquake', 'hv1') not in lru.entries)
+        unit.assert_(('geo', 'Troy%2C+NY') in lru.entries)
+        lru.delete('earthquake', 'hv1')
+        # A failed batch leaves neither the database nor the memory tier
+        # with any of its writes
+        lru.begin()
+        lru.dump('geo', {'address': 'Nowhere'}, 'Troy%2C+NY')
+        lru.begin()
+        lru.dump('earthquake', {'id': 'ak3'}, 'ak3')
+        lru.commit()
+        unit.assertEqual(lru.load('earthquake', 'ak3'), {'id': 'ak3'})
+        unit.assert_(not STORES['sqlite'](root).exists('earthquake', 'ak3'))
+        lru.rollback()
+        unit.assertEqual(lru.load('geo', 'Troy%2C+NY'),
+                         {'address': 'Troy, NY, USA'})
+        unit.assert_(not lru.exists('earthquake', 'ak3'))
+        # Writes of other processes replace or drop the cached entries
+        other = LRUStore(STORES['sqlite'](root))
+        for store in (lru, other):
+            store.load('geo', 'Troy%2C+NY')
+            store.load('earthquake', 'us1')
+        other.dump('geo', {'address': 'Troy, NY'}, 'Troy%2C+NY', time.time())
+        other.delete('earthquake', 'us1')
+        unit.assertEqual(lru.load('earthquake', 'us1'), {'id': 'us1',
+                                                          'version': '2'})
+        lru.checked -= lru.interval
+        unit.assertEqual(lru.load('geo', 'Troy%2C+NY'), {'address': 'Troy, NY'})
+        unit.assertEqual(lru.load('earthquake', 'us1'), None)
+        unit.assert_(not lru.exists('earthquake', 'us1'))
+        other.close()
+        lru.close()
+        files = LRUStore(files)
+        files.load('geo', 'Albany%2C+NY')
+        files.load('geo', 'Albany%2C+NY')
+        unit.assertEqual((files.hits, files.misses), (1, 1))
+        path = os.path.join(root, 'observations', 'all_xml.zip')
+        f = AtomicFile(path)
+        f.write('PK')
+        unit.assert_(not os.path.exists(path))
+        f.close()
+        unit.assertEqual(open(path).read(), 'PK')
+        unit.assertEqual(os.listdir(os.path.dirname(path)), ['all_xml.zip'])
+        lock = FileLock(os.path.join(root, '.earthquake.lock'))
+        unit.assert_(lock.acquire())
+        if fcntl is not None:
+            unit.assert_(not FileLock(lock.path).acquire(blocking=False))
+        lock.release()
+        unit.assert_(FileLock(lock.path).acquire(blocking=False))
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,380 @@
+"""Shared HTTP transport used by every fetcher
+
+One ``Transport`` (``earth.core.transport.transport``) keeps idle keep-alive
+connections per host, applies connect and read timeouts, retries failed
+requests with backoff and calls instrumentation hooks after every attempt::
+
+    from earth.core.transport import transport
+    transport.read_timeout = 10
+    transport.hooks.append(lambda event: log(event))
+    data = transport.open('http://www.weather.gov/alerts/ak.cap').read()
+
+"""
+import httplib
+import os
+import socket
+import threading
+import time
+from urlparse import urlsplit, urljoin
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from earth.core import USER_AGENT
+from earth.core.store import AtomicFile, replace
+
+REDIRECTS = (301, 302, 303, 307)
+RETRY_STATUS = (500, 502, 503, 504)
+CHUNK_SIZE = 64 * 1024
+# Response validators kept by update() and the request headers they feed
+CONDITIONS = (('ETag', 'If-None-Match'),
+              ('Last-Modified', 'If-Modified-Since'))
+
+class HTTPError(IOError):
+    """Upstream answered with an error status"""
+    def __init__(self, url, status, reason):
+        IOError.__init__(self, 'http error', status, reason)
+        self.url, self.status, self.reason = url, status, reason
+    def __str__(self):
+        return '%s %s: %s' % (self.status, self.reason, self.url)
+
+class Backoff(object):
+
+    """Bounded retry policy with exponential backoff
+
+    ``delays()`` generates the pause before each retry: delay, delay*factor,
+    ... capped at max_delay, ``retries`` times.
+
+    """
+
+    def __init__(self, retries=2, delay=.1, factor=2, max_delay=2):
+        self.retries = retries
+        self.delay = delay
+        self.factor = factor
+        self.max_delay = max_delay
+
+    def delays(self):
+        delay = self.delay
+        for x in range(self.retries):
+            yield min(delay, self.max_delay)
+            delay *= self.factor
+
+class Response(object):
+
+    """Fully read HTTP response, usable like the file urlopen returns"""
+
+    def __init__(self, url, status, reason, headers, data):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.data = data
+        self.fp = StringIO(data)
+
+    def read(self, *args):
+        return self.fp.read(*args)
+    def readline(self, *args):
+        return self.fp.readline(*args)
+    def readlines(self):
+        return self.fp.readlines()
+    def __iter__(self):
+        return iter(self.fp)
+    def close(self):
+        pass
+    def geturl(self):
+        return self.url
+    def info(self):
+        return self.headers
+
+class Transport(object):
+
+    """Pooled keep-alive HTTP client with timeouts, retries and hooks
+
+    Hooks are called with a dict describing each attempt: method, url,
+    status (None on error), error, attempt and elapsed seconds.
+
+    """
+
+    def __init__(self, connect_timeout=10, read_timeout=30, backoff=None,
+                 max_idle=4):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.backoff = backoff or Backoff()
+        self.max_idle = max_idle
+        self.hooks = []
+        # earth.core.replay.Fixtures serving or recording every request
+        self.fixtures = None
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def _connection(self, key):
+        self.lock.acquire()
+        try:
+            idle = self.pools.get(key)
+            if idle:
+                return idle.pop(), True
+        finally:
+            self.lock.release()
+        scheme,host,port = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port,
+                                           timeout=self.connect_timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port,
+                                          timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn, False
+
+    def _release(self, key, conn, response):
+        if response.will_close:
+            conn.close()
+            return
+        self.lock.acquire()
+        try:
+            idle = self.pools.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def notify(self, **event):
+        for hook in self.hooks:
+            hook(event)
+
+    def _send(self, method, url, data, headers):
+        """One request on a pooled connection, returns (key, conn, response)
+
+        A reused connection the server has since dropped is retried once on
+        a fresh one without counting as a failed attempt. With fixtures
+        installed the response comes from (or is saved to) a fixture file.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        all_headers = {'User-Agent': USER_AGENT}
+        if data is not None:
+            all_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        all_headers.update(headers or {})
+        fixtures = self.fixtures
+        if fixtures is not None and not fixtures.record:
+            response = fixtures.load(method, url, data, all_headers)
+            return key, response, response
+        while 1:
+            conn,reused = self._connection(key)
+            try:
+                conn.request(method, path, data, all_headers)
+                response = conn.getresponse()
+                break
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+        if fixtures is not None:
+            body = response.read()
+            self._release(key, conn, response)
+            response = fixtures.save(method, url, data, response, body)
+            return key, response, response
+        return key, conn, response
+
+    def _pause(self, delays):
+        """Sleeps before the next retry, False when retries are used up"""
+        for delay in delays:
+            time.sleep(delay)
+            return True
+        return False
+
+    def request(self, url, data=None, headers=None, handler=None):
+        """Performs a request, following redirects and retrying failures
+
+        handler(response) consumes the httplib response body before the
+        connection goes back to the pool; by default it is read into memory.
+        Returns (response, handler result). Error statuses raise HTTPError.
+        """
+        method = data is None and 'GET' or 'POST'
+        delays = self.backoff.delays()
+        attempt = 0
+        redirects = 0
+        while 1:
+            attempt += 1
+            start = time.time()
+            try:
+                key,conn,response = self._send(method, url, data, headers)
+                try:
+                    if handler is None or not 200 <= response.status < 300:
+                        result = response.read()
+                    else:
+                        result = handler(response)
+                except:
+                    # Never pool a connection with an unread body
+                    conn.close()
+                    raise
+                self._release(key, conn, response)
+            except (socket.error, httplib.HTTPException), e:
+                self.notify(method=method, url=url, status=None, error=e,
+                             attempt=attempt, elapsed=time.time() - start)
+                if not self._pause(delays):
+                    if isinstance(e, IOError):
+                        raise e
+                    raise IOError(e)
+                continue
+            self.notify(method=method, url=url, status=response.status,
+                         error=None, attempt=attempt,
+                         elapsed=time.time() - start)
+            if response.status in REDIRECTS and redirects < 5:
+                redirects += 1
+                url = urljoin(url, response.getheader('location'))
+                method,data = 'GET',None
+                continue
+            if response.status in RETRY_STATUS and self._pause(delays):
+                continue
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason)
+            return response, result
+
+    def open(self, url, data=None, headers=None):
+        """Returns the fully read Response for url (POSTs data if given)"""
+        response,body = self.request(url, data, headers)
+        return Response(url, response.status, response.reason,
+                        dict(response.getheaders()), body)
+
+    def retrieve(self, url, path, headers=None):
+        """Streams url into path, atomically replacing it once complete"""
+        def save(response):
+            f = AtomicFile(path)
+            try:
+                while 1:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            except:
+                f.discard()
+                raise
+            f.close()
+        return self.request(url, headers=headers, handler=save)[0]
+
+    def update(self, url, path):
+        """Retrieves url into path only if it changed upstream
+
+        The ETag and Last-Modified of a download are kept next to the file
+        in <path>.pending until confirm(path), once the file was used (eg.
+        parsed and stored), moves them to <path>.validators. Only confirmed
+        validators are sent back as If-None-Match and If-Modified-Since, so
+        a download that was never used is downloaded again. Returns False
+        when upstream answered 304 Not Modified and path was left alone,
+        True when it was (re)written.
+        """
+        validators = path + '.validators'
+        headers = {}
+        if os.path.isfile(path) and os.path.isfile(validators) and \
+           not os.path.isfile(path + '.pending'):
+            names = dict(CONDITIONS)
+            for line in open(validators):
+                name,value = line.rstrip('\r\n').split(': ', 1)
+                headers[names[name]] = value
+        response = self.retrieve(url, path, headers)
+        if response.status == 304:
+            return False
+        f = AtomicFile(path + '.pending')
+        for name,header in CONDITIONS:
+            value = response.getheader(name)
+            if value:
+                f.write('%s: %s\n' % (name, value))
+        f.close()
+        return True
+
+    def confirm(self, path):
+        """Keeps the validators of the last update() of path, see update()"""
+        if os.path.isfile(path + '.pending'):
+            replace(path + '.pending', path + '.validators')
+
+    def invalidate(self, path):
+        """Forgets the validators of path so the next update() downloads it"""
+        for name in (path + '.validators', path + '.pending'):
+            if os.path.isfile(name):
+                os.remove(name)
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for idle in self.pools.values():
+                for conn in idle:
+                    conn.close()
+            self.pools.clear()
+        finally:
+            self.lock.release()
+
+transport = Transport()
+
+def test(unit):
+    import BaseHTTPServer, tempfile, shutil
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        failures = [503]
+        def do_GET(self):
+            if self.path == '/flaky' and self.failures:
+                status,body = self.failures.pop(), 'try again'
+            elif self.path == '/etag':
+                if self.headers.get('If-None-Match') == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', '"v1"')
+                self.send_header('Content-Length', '4')
+                self.end_headers()
+                self.wfile.write('v1v1')
+                return
+            elif self.path == '/moved':
+                self.send_response(302)
+                self.send_header('Location', '/flaky')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            else:
+                status,body = 200, '%s %s' % (self.path, self.client_address[1])
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    client = Transport(backoff=Backoff(delay=0))
+    root = tempfile.mkdtemp()
+    try:
+        events = []
+        client.hooks.append(events.append)
+        url = 'http://127.0.0.1:%d' % server.server_port
+        # Redirect, then a 503 retried on the same kept-alive connection
+        body = client.open(url + '/moved').read()
+        unit.assertEqual([e['status'] for e in events], [302, 503, 200])
+        port = body.split()[1]
+        unit.assertEqual(client.open(url + '/again').read(), '/again %s' % port)
+        unit.assertRaises(IOError, Transport(backoff=Backoff(0)).open,
+                          'http://127.0.0.1:1/')
+        # Conditional GET: until confirmed the download is fetched again,
+        # then the next update is a 304 that leaves path alone
+        path = os.path.join(root, 'etag')
+        unit.assert_(client.update(url + '/etag', path))
+        unit.assert_(client.update(url + '/etag', path))
+        client.confirm(path)
+        unit.assert_(not client.update(url + '/etag', path))
+        unit.assertEqual(open(path).read(), 'v1v1')
+        client.invalidate(path)
+        unit.assert_(client.update(url + '/etag', path))
+        unit.assertEqual(sorted(os.listdir(root)), ['etag', 'etag.pending'])
+    finally:
+        shutil.rmtree(root)
+        client.close()
+        server.shutdown()
+        server.server_close()
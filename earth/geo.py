@@ -1,14 +1,16 @@
-from urllib import urlopen, quote_plus, urlencode
+from urllib import quote_plus, urlencode
 from earth.core.config import conf
 from earth.core import force_unicode
+from earth.core.transport import transport
+from earth.core.spatial import SpatialIndex
 import os
+import zipfile
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
     
 URL = 'http://maps.google.com/maps/geo?'
-URI_ROOT = os.path.join(conf.data_root,'geo')
 ACCURACIES = {
     0:'Unknown accuracy.',
     1:'Country level accuracy.',
@@ -21,10 +23,12 @@ ACCURACIES = {
     8:'Address level accuracy.',
     9:'Premise (building name, property name, shopping center, etc.) level accuracy.',
 }
+# GeoNames dump of the places with a population over 15000, see gazetteer()
+GAZETTEER_URL = 'http://download.geonames.org/export/dump/cities15000.zip'
+# Relative to the data root unless absolute
+GAZETTEER_URI = os.path.join('geo', 'cities15000.zip')
 
-conf.mkdirs('geo')
-
-def geocode(query):
+def geocode_url(query):
     #http://code.google.com/apis/maps/documentation/geocoding/index.html
     params = {
         'sensor': conf.get('geo','sensor','false'),
@@ -42,9 +46,12 @@ def geocode(query):
     spn = conf.get('geo','span')
     if len(spn):
         params['spn'] = spn
-    params = urlencode(params)
+    return URL + urlencode(params)
+
+def parse_geocode(text):
+    """Returns the most accurate placemark of a geocoder response"""
     try:
-        data = eval(urlopen(URL + params).read(), {}, {}) 
+        data = eval(text, {}, {}) 
     except:
         raise TypeError('Bad data from google')
     best,result = -1,{}
@@ -56,7 +63,157 @@ def geocode(query):
     del data,best
     return result
 
+def geocode(query):
+    try:
+        text = transport.open(geocode_url(query)).read()
+    except IOError:
+        raise TypeError('Bad data from google')
+    return parse_geocode(text)
+
+class Gazetteer(object):
+
+    """Places of a GeoNames dump indexed by position, to reverse geocode
+    points without the network
+
+    Places are (name, admin1 code, country code, lat, lon) tuples.
+    """
+
+    def __init__(self, places):
+        self.places = list(places)
+        self.index = SpatialIndex([(i, place[3], place[4])
+                                   for i,place in enumerate(self.places)])
+
+    @classmethod
+    def load(cls, path):
+        """Reads a GeoNames dump, tab separated text or a zip of it"""
+        if zipfile.is_zipfile(path):
+            zfile = zipfile.ZipFile(path)
+            try:
+                names = [name for name in zfile.namelist()
+                         if name.endswith('.txt')]
+                lines = zfile.read(names[0]).splitlines()
+            finally:
+                zfile.close()
+        else:
+            lines = open(path, 'rb').read().splitlines()
+        places = []
+        for line in lines:
+            fields = line.split('\t')
+            try:
+                places.append((fields[1].decode('utf8'), fields[10],
+                               fields[8], float(fields[4]),
+                               float(fields[5])))
+            except (IndexError, ValueError):
+                continue
+        return cls(places)
+
+    def __len__(self):
+        return len(self.places)
+
+    def nearest(self, lat, lon):
+        """(place, km) of the place closest to lat, lon, None when empty"""
+        found = self.index.nearest(lat, lon)
+        if found:
+            return self.places[found[0]], found[1]
+
+    def placemark(self, lat, lon):
+        """Geocoder placemark of the place closest to lat, lon, {} when
+        there is none, with its distance in km"""
+        found = self.nearest(lat, lon)
+        if found is None:
+            return {}
+        (name,admin,country,plat,plon),km = found
+        area = {'Locality': {'LocalityName': name}}
+        if admin:
+            area['AdministrativeAreaName'] = admin
+        return {
+            'address': u', '.join([part for part in (name, admin, country)
+                                   if part]),
+            'AddressDetails': {'Accuracy': 4, 'Country': {
+                'CountryName': country, 'CountryNameCode': country,
+                'AdministrativeArea': area}},
+            'Point': {'coordinates': [plon, plat, 0]},
+            'distance': km,
+        }
+
+    def reverse(self, lats, lons):
+        """Locations of the places closest to each point
+
+        lats and lons are sequences (or NumPy arrays) of the same length;
+        points repeated in them are looked up once. This is still a Python
+        loop of one KD-tree query per distinct point, not a vectorized
+        lookup, so it is no faster per point than placemark().
+        """
+        found,result = {},[]
+        for point in zip(lats, lons):
+            point = float(point[0]), float(point[1])
+            if point not in found:
+                found[point] = self.placemark(*point)
+            result.append(Location.from_data(found[point]))
+        return result
+
+_gazetteers = {}
+# Paths of the missing gazetteers already logged
+_missing = set()
+
+def gazetteer_path():
+    """The geo.gazetteer option, GAZETTEER_URI under the data root if unset"""
+    if conf.conf.has_option('geo', 'gazetteer'):
+        return conf.get('geo', 'gazetteer')
+    return os.path.join(conf.data_root, GAZETTEER_URI)
+
+def fetch_gazetteer():
+    """Downloads the GeoNames dump if it changed upstream"""
+    path = os.path.join(conf.data_root, GAZETTEER_URI)
+    changed = transport.update(GAZETTEER_URL, path)
+    transport.confirm(path)
+    return changed
+
+def cron():
+    """Keeps the gazetteer current, run it with the other cron jobs
+
+    Returns True when a new GeoNames dump was downloaded. Does nothing
+    when the geo.gazetteer option names a file of your own.
+    """
+    if conf.conf.has_option('geo', 'gazetteer'):
+        return False
+    lock = conf.lock('geo')
+    lock.acquire()
+    try:
+        return fetch_gazetteer()
+    finally:
+        lock.release()
+
+def gazetteer():
+    """Gazetteer of gazetteer_path(), read once per version of the file
+
+    Raises IOError when it is missing, see cron().
+    """
+    path = gazetteer_path()
+    if not os.path.isfile(path):
+        raise IOError('No gazetteer at %s' % path)
+    key = path, os.path.getmtime(path)
+    if key not in _gazetteers:
+        _gazetteers.clear()
+        _gazetteers[key] = Gazetteer.load(path)
+    return _gazetteers[key]
+
+def reverse_geocode(lats, lons):
+    """Locations of the places closest to many points, without the network
+
+        labels = [l.address for l in reverse_geocode(lats, lons)]
+    """
+    return gazetteer().reverse(lats, lons)
+
 class Location(dict):
+
+    """Geocoded place of a query or a point
+
+    Points (lat, lon floats) are reverse geocoded with the local
+    gazetteer(); without one, or with live=True, they go to Google like
+    queries do, through the cache unless live.
+    """
+
     def __init__(self, *args, **kwargs):
         sep = '+'
         if not args:
@@ -65,14 +222,28 @@ class Location(dict):
             sep = ','
         query = sep.join(map(lambda x: quote_plus(str(x)), args))
         live = kwargs.pop('live',None)
-        if conf.resource_exists('geo',query) and not live:
-            dict.__init__(self, conf.load('geo',query))
-        else:
+        if sep == ',' and not live:
+            try:
+                dict.__init__(self, gazetteer().placemark(*args[:2]))
+                return
+            except IOError, e:
+                if gazetteer_path() not in _missing:
+                    _missing.add(gazetteer_path())
+                    conf.log('warning', '%s, geocoding points online' % e)
+        if live:
             data = geocode(query, **kwargs)
             conf.dump('geo', data, query)
-            dict.__init__(self, data)
-            del data
-        del live
+        else:
+            data = conf.cached('geo', query, lambda: geocode(query, **kwargs))
+        dict.__init__(self, data)
+        del data,live
+
+    @classmethod
+    def from_data(cls, data):
+        """Location of a placemark, without geocoding"""
+        location = cls.__new__(cls)
+        dict.__init__(location, data)
+        return location
 
     @property
     def _AddressDetail(self):
@@ -1,8 +1,8 @@
 from urllib import urlencode
-import urllib2
 from earth.geo import Location
 from earth.core.config import conf
 from earth.core import RequestError
+from earth.core.transport import transport
 from datetime import date,time,datetime
 import os,sys
 import re
@@ -22,10 +22,8 @@ def reports(query):
     for id,type in REPORT_TYPES:
         yield SunReport(query,report_type=id)
 
-def get_sun_report(**kwargs):
-    """
-    Basic function for fetching sun report data
-    """
+def sun_report_request(**kwargs):
+    """Returns the (url, form data) of a sun report request"""
     vars = {'FFX' : 1,  'ZZZ' : 'END',
             'xxy' : kwargs['year'], 'type' : kwargs['report_type']}
     if 'location' in kwargs:
@@ -36,13 +34,10 @@ def get_sun_report(**kwargs):
     else:
         vars['st'] = kwargs.pop('st','')
         vars['place'] = kwargs.pop('place','')
-    vars = urlencode(vars)
-    try:
-        lines = urllib2.urlopen(urllib2.Request(URL, vars)).readlines()
-    except IOError, e:
-        conf.log('warning','RequestError: %s'%e)
-        raise RequestError, e
+    return URL, urlencode(vars)
 
+def parse_sun_report(lines, year):
+    """Maps each date of the USNO table to its (rise, set) times"""
     data = {}
     def liner(line):
         while 1:
@@ -64,11 +59,22 @@ def get_sun_report(**kwargs):
             continue
         for i,(r,s) in enumerate(liner(l[2:].strip())):
             try:
-                data[( date(int(kwargs['year']), i, int(day)) )] = ( r, s )
+                data[( date(int(year), i, int(day)) )] = ( r, s )
             except ValueError:
                 continue
     return data
 
+def get_sun_report(**kwargs):
+    """
+    Basic function for fetching sun report data
+    """
+    try:
+        lines = transport.open(*sun_report_request(**kwargs)).readlines()
+    except IOError, e:
+        conf.log('warning','RequestError: %s'%e)
+        raise RequestError, e
+    return parse_sun_report(lines, kwargs['year'])
+
 class SunReport(dict):
     def __init__(self, query, **kwargs):
         self.location = Location(query)
@@ -76,12 +82,8 @@ class SunReport(dict):
         self.report_type = kwargs.get('report_type',0)
         assert self.report_type in range(5), 'Invalid report type'
         self.id = '%s.%s.%s'%(self.location,self.year,self.report_type_text)
-        if conf.resource_exists('sun',self.id):
-            dict.__init__(self, conf.load('sun',self.id))
-        else:
-            data = get_sun_report(year=self.year,location=self.location,**kwargs)
-            conf.dump('sun', data, self.id)
-            dict.__init__(self, data)
+        dict.__init__(self, conf.cached('sun', self.id,
+            lambda: get_sun_report(year=self.year,location=self.location,**kwargs)))
     @property
     def report_type_text(self):
         return REPORT_TYPES[self.report_type][1]
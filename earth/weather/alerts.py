@@ -4,21 +4,24 @@ import time
 from urllib import urlencode
 from earth.core.config import conf
 from datetime import datetime, timedelta
-try:
-    from lxml import objectify
-except ImportError:
-    raise ImportError, "Missing dependency: lxml"
-
 from earth.core.iso8601 import parse_date as xml_time_parse
-from earth.core import HTTPRequest, RequestError, ScrapeError
+from earth.core import RequestError, ScrapeError, require
+from earth.core.transport import transport
 
-def get_cap_alert(region):
-    url = 'http://www.weather.gov/alerts/%s.cap' % region
+CAP_URL = 'http://www.weather.gov/alerts/%s.cap'
+ZONE_URL = 'http://www.weather.gov/alerts/wwarssget.php?zone=%s'
+STATE_URL = 'http://www.weather.gov/alerts/%s.rss'
+
+def _fetch(url):
     try:
-        xmldom = objectify.fromstring(HTTPRequest().open(url).read())
+        return transport.open(url).read()
     except IOError, e:
         conf.log('warning','RequestError: %s'%e)
         raise RequestError, e
+
+def parse_cap_alert(xml_string):
+    objectify = require('lxml.objectify')
+    xmldom = objectify.fromstring(xml_string)
     area_re = re.compile(r'(.+) \((\D+)\)')
     sent = xmldom.sent.text
     sent_time,sent_tz = sent[:-6],sent[-6:].replace(':','')
@@ -57,29 +60,21 @@ def get_cap_alert(region):
             })
     return data
 
+def get_cap_alert(region):
+    return parse_cap_alert(_fetch(CAP_URL % region))
+
 class CapAlert(dict):
     def __init__(self, region):
-        if conf.resource_exists('alerts','%s.cap'%region):
-            dict.__init__(self, conf.load('alerts','%s.cap'%region))
-        else:
-            dict.__init__(self, get_cap_alert(region))
-            conf.dump('alerts', dict(self), '%s.cap'%region)
+        dict.__init__(self, conf.cached('alerts', '%s.cap'%region,
+                                        lambda: get_cap_alert(region)))
 
-def get_zone_alert(zone):
-    """Returns alert data for a particular County/Zone Code.
-    
-    The County/Zone codes can be found here: 
-    http://www.weather.gov/alerts/
+def parse_zone_alert(xml_string):
+    """Parses the RSS feed of a County/Zone alert.
     
     This XML was formatted pretty badly (had extra spaces and
     newlines), so the .strip() was run on all string.
     """
-    url = "http://www.weather.gov/alerts/wwarssget.php?zone=%s"%zone
-    try:
-        xml_string = HTTPRequest().open(url).read()
-    except IOError, e:
-        conf.log('warning','RequestError: %s'%e)
-        raise RequestError, e
+    objectify = require('lxml.objectify')
     xmldom = objectify.fromstring(xml_string)
     c = xmldom.channel
     return {'title': c.title.text.strip(),
@@ -102,27 +97,22 @@ def get_zone_alert(zone):
              'description': c.item.description.text.strip()
              }
     }
-    
-class ZoneAlert(dict):
-    def __init__(self, zone):
-        if conf.resource_exists('alerts','%s.zone' % zone):
-            dict.__init__(self, conf.load('alerts','%s.zone' % zone))
-        else:
-            dict.__init__(self, get_zone_alert(zone))
-            conf.dump('alerts', dict(self), '%s.zone' % zone)
 
-def get_state_alert(state):
-    """Returns alert data for a particular state.
+def get_zone_alert(zone):
+    """Returns alert data for a particular County/Zone Code.
     
-    More information can be found here:
+    The County/Zone codes can be found here: 
     http://www.weather.gov/alerts/
     """
-    url = "http://www.weather.gov/alerts/%s.rss" % state.lower()
-    try:
-        xml_string = HTTPRequest().open(url).read()
-    except IOError, e:
-        conf.log('warning','RequestError: %s' % e)
-        raise RequestError, e
+    return parse_zone_alert(_fetch(ZONE_URL % zone))
+    
+class ZoneAlert(dict):
+    def __init__(self, zone):
+        dict.__init__(self, conf.cached('alerts', '%s.zone' % zone,
+                                        lambda: get_zone_alert(zone)))
+
+def parse_state_alert(xml_string):
+    objectify = require('lxml.objectify')
     xmldom = objectify.fromstring(xml_string)
     title_re = re.compile(r'^(.*) - (.*) \((.*)\)')
     desc_re = re.compile(r'.* At:  (.*)\n.* At:  (.*)\n.* Homepage:  (.*)')
@@ -166,13 +156,18 @@ def get_state_alert(state):
                               'link': link})
     return data
 
+def get_state_alert(state):
+    """Returns alert data for a particular state.
+    
+    More information can be found here:
+    http://www.weather.gov/alerts/
+    """
+    return parse_state_alert(_fetch(STATE_URL % state.lower()))
+
 class StateAlert(dict):
     def __init__(self, state):
-        if conf.resource_exists('alerts','%s.state'%state):
-            dict.__init__(self, conf.load('alerts','%s.state'%state))
-        else:
-            dict.__init__(self, get_state_alert(state))          
-            conf.dump('alerts', dict(self), '%s.state'%state)
+        dict.__init__(self, conf.cached('alerts', '%s.state'%state,
+                                        lambda: get_state_alert(state)))
 
 def test(unit):
     unit.assertEqual(CapAlert('ak')['info_list']['area'],
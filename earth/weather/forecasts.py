@@ -73,23 +73,24 @@ wspd_r       Real-time Mesoscale Analysis Wind Speed
 import re
 from datetime import datetime, timedelta
 
-try:
-    from lxml import etree
-except ImportError:
-    raise ImportError, "Missing dependency: lxml"
-
 from earth.core.iso8601 import parse_date as xml_time_parse
-from earth.core import HTTPRequest, SoapClient
+from earth.core import SoapClient, require
+from earth.core.transport import transport
 
 WSDL_FILE = 'http://www.weather.gov/forecasts/xml/DWMLgen/wsdl/ndfdXML.wsdl'
 GLANCE_PARAMS = ('maxt', 'mint', 'sky', 'wx', 'icons')
 
 class Forecast(object):
 
-    """Fill this in."""
+    """Fill this in.
+
+    The NDFD service description is parsed once per process and its WSDL
+    kept in the store, so constructing a Forecast is cheap. backoff is the
+    retry policy for failed SOAP calls (see earth.core.transport.Backoff).
+    """
 
-    def __init__(self):
-        self.client = SoapClient(WSDL_FILE)
+    def __init__(self, backoff=None):
+        self.client = SoapClient(WSDL_FILE, backoff)
         self.today = datetime.now()
         self.low_date = datetime(2000, 01, 01)
         self.high_date = self.today + timedelta(days=100)
@@ -139,6 +140,7 @@ class Forecast(object):
 
     def _get_lat_lon_points(self, xml_string):
         """Extracts single or multiple lat/lon from the xml."""
+        etree = require('lxml.etree')
         tree = etree.fromstring(xml_string)
         lat_lon_string = tree.xpath('//latLonList')[0].text
         return [x.split(',') for x in lat_lon_string.split(' ')]
@@ -166,6 +168,7 @@ class Forecast(object):
         This is used for most parameters as their structures are identical.
 
         """
+        etree = require('lxml.etree')
         tree = etree.fromstring(xml_string)
         point = tree.xpath('//parameters[@applicable-location="%s"]' %
                 location)[0]
@@ -195,6 +198,7 @@ class Forecast(object):
 
         """
         
+        etree = require('lxml.etree')
         tree = etree.fromstring(xml_string)
         point = tree.xpath('//parameters[@applicable-location="%s"]' %
                 location)[0]
@@ -213,6 +217,7 @@ class Forecast(object):
         
         """
         
+        etree = require('lxml.etree')
         xmldom = etree.fromstring(xml_string)
         self._get_points(xmldom)
         self._get_time_layouts(xmldom)
@@ -296,6 +301,7 @@ class Forecast(object):
     def _wx(self, location, xml_string):
         name = "Weather Type, Coverage, and Intensity"
         vis_re = re.compile(r'.*(\d+).*')
+        etree = require('lxml.etree')
         tree = etree.fromstring(xml_string)
         point = tree.xpath('//parameters[@applicable-location="%s"]' %
                 location)[0]
@@ -373,6 +379,7 @@ class Forecast(object):
 
     def _waveh(self, location, xml_string):
         name = "Wave Height"
+        etree = require('lxml.etree')
         tree = etree.fromstring(xml_string)
         point = tree.xpath('//parameters[@applicable-location="%s"]' %
                 location)[0]
@@ -834,7 +841,7 @@ def full_text_forecast(state_abbr, zone):
     URL_TEMPLATE = 'http://weather.noaa.gov/pub/data/forecasts/zone/%s/%s'
     filename = '%sz%s.txt' % (state_abbr.lower(), zone)
     url = URL_TEMPLATE % (state_abbr.lower(), filename)
-    forecast = HTTPRequest().open(url).read().split('\n')
+    forecast = transport.open(url).read().split('\n')
     dl = forecast[0]
     expires = datetime(int(dl[8:12]), int(dl[12:14]), int(dl[14:16]), 
                        int(dl[16:18]), int(dl[18:20]))
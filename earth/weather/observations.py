@@ -1,37 +1,424 @@
 import os,sys
+import re
+import time
+import calendar
 import zipfile
-from xml.parsers.expat import ParserCreate
+from collections import Mapping
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+from xml.parsers.expat import ParserCreate, ExpatError
 from datetime import datetime
-from urllib import urlretrieve
+from email.utils import parsedate_tz, mktime_tz
 from earth.core.config import conf
+from earth.core.transport import transport
+from earth.core.spatial import SpatialIndex
+from earth.core.columns import ColumnBuilder
+from earth.core.history import History
+from earth.core.pack import PackWriter, PackFile
+from earth.core.rules import Rule, RuleIndex
 from earth.geo import Location
     
 URL = 'http://www.weather.gov/data/current_obs/all_xml.zip'
-URI = os.path.join(conf.data_root, 'observations', 'all_xml.zip')
-
-conf.mkdirs('observations')
+# One station's current observation, polled for the hotlist
+STATION_URL = 'http://www.weather.gov/data/current_obs/%s.xml'
+# Fields of the columnar snapshot, see snapshot()
+NUMERIC_FIELDS = ('temp_f', 'temp_c', 'dewpoint_f', 'dewpoint_c',
+                  'relative_humidity', 'wind_mph', 'wind_degrees',
+                  'wind_gust_mph', 'pressure_mb', 'pressure_in',
+                  'visibility_mi', 'heat_index_f', 'windchill_f',
+                  'latitude', 'longitude')
+CATEGORICAL_FIELDS = ('station_id', 'state', 'weather', 'wind_dir')
+# Fields kept in each station's history, see history()
+HISTORY_FIELDS = NUMERIC_FIELDS[:-2]
+# Relative to the data root unless absolute
+URI = os.path.join('observations', 'all_xml.zip')
+# Every station of the last refresh in one file, see station_pack()
+PACK = os.path.join('observations', 'stations.pack')
+# Elements of a current_observation document, in schema order
+FIELDS = ('current_observation', 'credit', 'credit_url', 'url', 'title',
+          'link', 'suggested_pickup', 'suggested_pickup_period', 'location',
+          'station_id', 'latitude', 'longitude', 'observation_time',
+          'observation_time_rfc822', 'weather', 'temperature_string',
+          'temp_f', 'temp_c', 'relative_humidity', 'wind_string', 'wind_dir',
+          'wind_degrees', 'wind_mph', 'wind_gust_mph', 'pressure_string',
+          'pressure_mb', 'pressure_in', 'dewpoint_string', 'dewpoint_f',
+          'dewpoint_c', 'heat_index_string', 'heat_index_f', 'heat_index_c',
+          'windchill_string', 'windchill_f', 'windchill_c', 'visibility_mi',
+          'icon_url_base', 'icon_url_name', 'two_day_history_url', 'ob_url',
+          'disclaimer_url', 'copyright_url', 'privacy_policy_url')
 
 def fetch():
-    urlretrieve(URL,URI)
+    """Downloads all_xml.zip if it changed upstream
+
+    Returns False when the local copy is current (304 Not Modified).
+    """
+    return transport.update(URL, os.path.join(conf.data_root, URI))
     
-def parse():
-    for station in get_weather_observations():
-        station = Station(station)
-        conf.dump('observations',dict(station),station.id)
+# Callables notified with the ChangeSet of every refresh, see subscribe()
+subscribers = []
+
+class ChangeSet(object):
+
+    """Ids of the stations one refresh added, updated and removed"""
+
+    def __init__(self, added=(), updated=(), removed=()):
+        self.added = list(added)
+        self.updated = list(updated)
+        self.removed = list(removed)
+
+    def __len__(self):
+        return len(self.added) + len(self.updated) + len(self.removed)
+
+    def __repr__(self):
+        return '<ChangeSet +%d ~%d -%d>' % (len(self.added),
+                                            len(self.updated),
+                                            len(self.removed))
+
+def subscribe(callback):
+    """Calls callback(changes) after every refresh that changed stations"""
+    subscribers.append(callback)
+
+def unsubscribe(callback):
+    subscribers.remove(callback)
+
+# Standing queries on the stations every refresh changes, see watch()
+rules = RuleIndex()
+
+def watch(target, near=None, **lookups):
+    """Delivers each new reading matching every lookup to target
+
+    Lookups are on the fields of the station and its state, as for
+    stations_where(); near=(lat, lon, km) limits the rule to the stations
+    within km of a point. target is called with (rule, station), or given
+    (rule, station) tuples when it is a queue::
+
+        watch(alert, wind_gust_mph__gt=50)
+        watch(queue, visibility_mi__lt=1, state='NY')
+        watch(alert, temp_f__gte=100, near=(42.65, -73.75, 100))
+
+    Only the stations a refresh (cron() or poll_hotlist()) changed are
+    matched, after it is stored. Returns the Rule, see unwatch().
+    """
+    return rules.add(Rule(target, near, **lookups))
+
+def unwatch(rule):
+    rules.remove(rule)
+
+def parse(workers=None, changes=None):
+    """Stores and generates every station of the snapshot
+
+    Only stations whose digest differs from the one stored by the last
+    parse are written; those that disappeared are deleted. The ids of both
+    are recorded in changes (a ChangeSet) when given.
+    Stations whose stored reading is newer, eg. from poll_hotlist(), are
+    left alone and generated as stored.
+
+    workers > 1 parses in that many processes (default: the
+    observations.workers option); stations come out in the same order
+    and with the same data either way.
+    """
+    if workers is None:
+        workers = conf.getint('observations', 'workers', 1)
+    if changes is None:
+        changes = ChangeSet()
+    digests = {}
+    if conf.resource_exists('digests', 'observations'):
+        digests = conf.load('digests', 'observations')
+    seen = {}
+    for station,digest in _observations(workers):
+        seen[station.id] = digest
+        if digests.get(station.id) != digest:
+            stored = None
+            if station.id in digests and \
+               conf.resource_exists('observations', station.id):
+                stored = Station(station.id)
+            if stored is not None and _older(station, stored):
+                # The hotlist already stored a later reading
+                station = stored
+                seen[station.id] = digests[station.id]
+            else:
+                conf.dump('observations',dict(station),station.id)
+                if stored is not None:
+                    changes.updated.append(station.id)
+                else:
+                    changes.added.append(station.id)
         yield station
+    for id in digests:
+        if id not in seen:
+            conf.delete('observations', id)
+            changes.removed.append(id)
+    conf.dump('digests', seen, 'observations')
+
+def _older(station, stored):
+    """Whether station was taken before the stored reading of it"""
+    return bool(station.timestamp and stored.timestamp and
+                station.timestamp < stored.timestamp)
+
+def cron(force=False):
+    """Fetches and stores observations, skipping the parse when unchanged
+
+    Returns the ChangeSet of the refresh, also stored as ('changes',
+    'observations') and passed to the subscribers when not empty. Every
+    station is also written to the pack read by stations(), and the
+    readings of the added and updated ones to their history().
+    """
+    changes = ChangeSet()
+    lock = conf.lock('observations')
+    lock.acquire()
+    try:
+        if not fetch() and not force:
+            return changes
+        def store():
+            pack = PackWriter(os.path.join(conf.data_root, PACK))
+            try:
+                points = []
+                columns = ColumnBuilder(NUMERIC_FIELDS, CATEGORICAL_FIELDS)
+                archive = station_history()
+                changed = 0
+                for station in parse(changes=changes):
+                    pack.add(station.id, dict(station))
+                    points.append((station.id,) + station.point)
+                    columns.add(station, state=station.state)
+                    # parse() records a station it stored before yielding
+                    # it, only those have a new reading
+                    stored = len(changes.added) + len(changes.updated)
+                    if stored > changed and station.id and station.timestamp:
+                        archive.append(station.id, station.timestamp, station)
+                    changed = stored
+                conf.dump('spatial', SpatialIndex(points), 'observations')
+                try:
+                    conf.dump('columns', columns.build(), 'observations')
+                except ImportError, e:
+                    conf.log('info', 'No columnar snapshot: %s' % e)
+                conf.dump('changes', changes, 'observations')
+            except:
+                pack.discard()
+                raise
+            pack.close()
+        conf.ingest(os.path.join(conf.data_root, URI), store)
+    finally:
+        lock.release()
+    _notify(changes)
+    return changes
+
+def _notify(changes):
+    if changes:
+        for callback in subscribers:
+            try:
+                callback(changes)
+            except Exception, e:
+                conf.log('warning', 'Subscriber %r failed: %s' % (callback, e))
+    if not len(rules):
+        return
+    for id in changes.added + changes.updated:
+        station = Station(id)
+        values = dict(station)
+        values['state'] = station.state
+        for rule in rules.match(values):
+            try:
+                rule.deliver(station)
+            except Exception, e:
+                conf.log('warning', '%r failed: %s' % (rule, e))
 
-def cron():
-    fetch()
-    [x for x in parse()]
+def hotlist():
+    """Ids of the stations in the observations.hotlist option"""
+    return [id.upper() for id in conf.getlist('observations', 'hotlist')]
 
-def get_weather_observations():
-    vs = {'tagdata':{},'tag':None,'data':[]}
+def fetch_station(id):
+    """Current observation of one station, None when it can not be had"""
+    try:
+        return parse_station(transport.open(STATION_URL % id).read())
+    except IOError, e:
+        conf.log('warning', 'No observation for %s: %s' % (id, e))
+    except StopIteration:
+        conf.log('warning', 'Empty observation for %s' % id)
+
+def poll_hotlist(ids=None, workers=None):
+    """Fetches the hotlist stations one by one and stores their readings
+
+    ids default to hotlist(); workers (default the hotlist_workers option)
+    fetch in parallel. A reading older than the stored one, eg. one the
+    bulk snapshot already superseded, is ignored. Returns the ChangeSet,
+    passed to the subscribers as for cron(), and updates the station pack
+    and the station_index() and snapshot() it was built with.
+    """
+    if ids is None:
+        ids = hotlist()
+    if workers is None:
+        workers = conf.getint('observations', 'hotlist_workers', 4)
+    changes = ChangeSet()
+    if not ids:
+        return changes
+    from multiprocessing.dummy import Pool
+    pool = Pool(max(min(workers, len(ids)), 1))
+    try:
+        fetched = pool.map(fetch_station, ids)
+    finally:
+        pool.close()
+        pool.join()
+    lock = conf.lock('observations')
+    lock.acquire()
+    try:
+        conf.begin()
+        try:
+            digests = {}
+            if conf.resource_exists('digests', 'observations'):
+                # Copied, the store may share the loaded object
+                digests = dict(conf.load('digests', 'observations'))
+            archive = station_history()
+            updates = {}
+            for station in fetched:
+                if station is None or not station.id:
+                    continue
+                stored = None
+                if conf.resource_exists('observations', station.id):
+                    stored = Station(station.id)
+                    if stored.digest == station.digest or \
+                       _older(station, stored):
+                        continue
+                    changes.updated.append(station.id)
+                else:
+                    changes.added.append(station.id)
+                conf.dump('observations', dict(station), station.id)
+                digests[station.id] = station.digest
+                updates[station.id] = dict(station)
+                if station.timestamp:
+                    archive.append(station.id, station.timestamp, station)
+            if updates:
+                conf.dump('digests', digests, 'observations')
+                _repack(updates)
+        except:
+            conf.rollback()
+            raise
+        conf.commit()
+    finally:
+        lock.release()
+    _notify(changes)
+    return changes
+
+def watch_hotlist(interval=None):
+    """Polls the hotlist forever, every interval seconds (default the
+    hotlist_interval option), while cron() keeps the rest up to date"""
+    if interval is None:
+        interval = conf.getint('observations', 'hotlist_interval', 60)
+    while 1:
+        start = time.time()
+        try:
+            poll_hotlist()
+        except Exception, e:
+            conf.log('error', 'Hotlist poll failed: %s' % e)
+        time.sleep(max(interval - (time.time() - start), 0))
+
+def _repack(updates):
+    """Rewrites the station pack with the records in updates (by id), and
+    the spatial and columnar snapshots built in the same pass"""
+    pack = station_pack()
+    if pack is None:
+        return
+    updates = dict(updates)
+    writer = PackWriter(os.path.join(conf.data_root, PACK))
+    points = []
+    columns = ColumnBuilder(NUMERIC_FIELDS, CATEGORICAL_FIELDS)
+    def add(id, record):
+        writer.add(id, record)
+        station = Station(record)
+        points.append((id,) + station.point)
+        columns.add(station, state=station.state)
+    try:
+        try:
+            for id,station in pack:
+                add(id, updates.pop(id, station))
+            for id,station in updates.items():
+                add(id, station)
+        finally:
+            pack.close()
+        conf.dump('spatial', SpatialIndex(points), 'observations')
+        try:
+            conf.dump('columns', columns.build(), 'observations')
+        except ImportError, e:
+            conf.log('info', 'No columnar snapshot: %s' % e)
+    except:
+        writer.discard()
+        raise
+    writer.close()
+
+def _station_names(zfile):
+    return [name for name in zfile.namelist()
+            if name.endswith('.xml') and not name.endswith('index.xml')]
+
+ENCODING = re.compile(r'^<\?xml[^>]*?encoding=["\']([A-Za-z0-9._-]+)["\']')
+
+def _decode(data):
+    """A document as UTF-8 without its xml declaration, decoded with the
+    encoding it declares, so documents can follow each other through one
+    parser"""
+    if data.startswith('\xff\xfe') or data.startswith('\xfe\xff'):
+        text = data.decode('utf-16')
+    else:
+        if data.startswith('\xef\xbb\xbf'):
+            data = data[3:]
+        match = ENCODING.match(data.lstrip())
+        text = data.decode(match and match.group(1) or 'utf-8')
+    return _strip_declaration(text).encode('utf-8')
+
+def _strip_declaration(text):
+    text = text.strip()
+    if text.startswith('<?xml '):
+        text = text[text.find('?>') + 2:]
+    return text
+
+def _members(zfile, names=None):
+    """Generates the (name, data) of the station documents of all_xml.zip"""
+    if names is None:
+        names = _station_names(zfile)
+    for name in names:
+        yield name, zfile.read(name)
+
+def parse_observations(zip_file, names=None):
+    """Generates a Station for each document of all_xml.zip (a path or file)
+
+    names limits the parse to those members of the zip.
+
+    The documents are fed one at a time through a single parser, wrapped in
+    one root element, and each Station is yielded as soon as its document
+    is parsed, so memory use does not grow with the number of stations.
+    """
+    zfile = zipfile.ZipFile(zip_file,'r')
+    try:
+        for station in _parse_documents(_members(zfile, names)):
+            yield station
+    finally:
+        zfile.close()
+
+def parse_station(xml):
+    """Station of a single current_obs document, eg. from STATION_URL"""
+    return _parse_documents([('station', xml)]).next()
+
+def _parse_documents(documents):
+    """Generates the Station of each current_observation document
+
+    documents are (name, data) pairs. A document that can not be decoded
+    or parsed is logged by name and skipped, the parser starts over with
+    the next one.
+    """
+    vs = {'tagdata':{},'tag':None,'done':[],'depth':0}
     
     def start(tag, attrs):
+        vs['depth'] += 1
+        if tag == 'current_observation':
+            vs['tagdata'] = {}
         if not tag == 'image':
             vs['tag'] = tag.lower()
             vs['tagdata'][vs['tag']] = None
     
+    def end(tag):
+        vs['depth'] -= 1
+        if tag == 'current_observation':
+            vs['done'].append(Station(vs['tagdata']))
+            vs['tag'] = None
+    
     def dodata(text):
         text = text.strip()
         if vs['tag'] and text:
@@ -44,26 +431,89 @@ def get_weather_observations():
                     try:
                         vs['tagdata'][vs['tag']] = float(text)
                     except ValueError:
-                        vs['tagdata'][vs['tag']] = str(text)
-                        
-    def feed(text):
-        vs['tagdata'],vs['tag'] = {},None
-        if text:
-            parser = ParserCreate()
-            parser.StartElementHandler = start
-            parser.CharacterDataHandler = dodata
-            parser.Parse(text, 1)
-            vs['data'].append(Station(vs['tagdata']))
-            
-    if not os.path.isfile(URI):
+                        try:
+                            vs['tagdata'][vs['tag']] = str(text)
+                        except UnicodeError:
+                            vs['tagdata'][vs['tag']] = text
+    
+    def create():
+        parser = ParserCreate('UTF-8')
+        parser.buffer_text = True
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = dodata
+        parser.Parse('<all_xml>', 0)
+        vs['depth'] = 1
+        return parser
+    parser = create()
+    for name,data in documents:
+        try:
+            text = _decode(data)
+            if not text:
+                continue
+            parser.Parse(text, 0)
+            if vs['depth'] != 1:
+                raise ExpatError('unclosed element')
+        except (ExpatError, UnicodeError, LookupError), e:
+            conf.log('warning', 'Skipping observation %s: %s' % (name, e))
+            del vs['done'][:]
+            vs['tag'] = None
+            parser = create()
+            continue
+        while vs['done']:
+            yield vs['done'].pop(0)
+    parser.Parse('</all_xml>', 1)
+
+_pools = {}
+
+def _pool(workers):
+    """Process pool of that many workers, started once and then reused"""
+    if workers not in _pools:
+        import multiprocessing
+        _pools[workers] = multiprocessing.Pool(workers)
+    return _pools[workers]
+
+def _parse_chunk(args):
+    """Pool worker: (Station, digest) of some members of a zip"""
+    return [(station, station.digest) for station in parse_observations(*args)]
+
+def parse_parallel(path, workers, chunk_size=None, digests=False):
+    """Generates the stations of all_xml.zip at path, parsed by a pool of
+    worker processes, in the same order as parse_observations(path)
+
+    The pool is kept for the next parse. Each chunk reopens the zip, which
+    reads its whole directory, so by default every worker gets about four
+    chunks. With digests=True generates (station, digest) pairs, the digest
+    worked out by the worker too.
+    """
+    zfile = zipfile.ZipFile(path,'r')
+    try:
+        names = _station_names(zfile)
+    finally:
+        zfile.close()
+    if chunk_size is None:
+        chunk_size = len(names) // (workers * 4) + 1
+    chunks = [(path, names[i:i + chunk_size])
+              for i in range(0, len(names), chunk_size)]
+    for stations in _pool(workers).imap(_parse_chunk, chunks):
+        for station,digest in stations:
+            if digests:
+                yield station, digest
+            else:
+                yield station
+
+def _observations(workers):
+    """(Station, digest) of each observation of the local all_xml.zip"""
+    uri = os.path.join(conf.data_root, URI)
+    if not os.path.isfile(uri):
         fetch()
-        
-    zfile = zipfile.ZipFile(URI,'r')
-    for name in zfile.namelist():
-        if name.endswith('.xml') and not name.endswith('index.xml'):
-            feed(zfile.read(name).strip())
+    if workers > 1:
+        return parse_parallel(uri, workers, digests=True)
+    return ((station, station.digest) for station in parse_observations(uri))
 
-    return vs['data']
+def get_weather_observations(workers=1):
+    """Generates a Station for each observation of the local all_xml.zip"""
+    return (station for station,digest in _observations(workers))
 
         
 
@@ -109,30 +559,212 @@ class Station(dict):
             return self['station_name']
     @property
     def geo(self):
-        if self.point:
-            return Location(*self.point,**{'live':True})
+        """Location of the station, None when its point can not be
+        geocoded"""
+        if None not in self.point:
+            try:
+                return Location(*map(float, self.point))
+            except (IOError, TypeError):
+                # geocode() raises TypeError when Google fails
+                return None
         if self.location:
-            return Location(self.location,**{'live':True})
+            return Location(self.location)
+    @property
+    def state(self):
+        """Two letter state at the end of the location, eg. 'Albany, NY'"""
+        state = (self.get('location') or '').split(', ')[-1].strip()
+        if len(state) == 2 and state.isupper():
+            return state
     @property
     def id(self):
         return self.get('station_id',None)
+    @property
+    def timestamp(self):
+        """Seconds since the epoch (UTC) the reading was taken"""
+        if self.get('observation_time_rfc822'):
+            parsed = parsedate_tz(self['observation_time_rfc822'])
+            if parsed:
+                return mktime_tz(parsed)
+    @property
+    def digest(self):
+        """Hash of the reading, changes whenever any of its values does"""
+        return md5(repr(sorted(self.items()))).hexdigest()
 
     def __repr__(self):
         return '<Station %s>'%self.id
 
-def stations(force_parse=False):
-    files = []
-    if os.path.isdir(os.path.join(conf.data_root, 'observations')):
-        files = [os.path.splitext(file)[0] for file in \
-            os.listdir(os.path.join(conf.data_root, 'observations')) \
-            if file.endswith('.obj')]
-    if not files or force_parse:
+    def compact(self):
+        return CompactStation(self)
+
+_index = dict([(field, i) for i,field in enumerate(FIELDS)])
+_missing = object()
+
+class CompactStation(object):
+
+    """Read-only Station that takes a fraction of the memory
+
+    Values of the known FIELDS are kept in a tuple and repeated strings are
+    shared between records. The derived properties are worked out once, when
+    the record is made, so reading them costs an attribute lookup.
+    """
+
+    __slots__ = ('_values', '_extra', 'id', 'timestamp', 'datetime', 'point',
+                 'location', 'icon', 'state', 'digest')
+
+    def __init__(self, data):
+        values,extra = [_missing] * len(FIELDS),None
+        for key,value in dict(data).items():
+            if isinstance(value, str):
+                value = intern(value)
+            if key in _index:
+                values[_index[key]] = value
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        self._values = tuple(values)
+        self._extra = extra
+        for name in ('id', 'timestamp', 'datetime', 'point', 'location',
+                     'icon', 'state'):
+            setattr(self, name, getattr(Station, name).fget(self))
+        # Of the original, whose keys the parser gives as unicode
+        self.digest = Station.digest.fget(data)
+
+    def __getitem__(self, key):
+        if key in _index:
+            value = self._values[_index[key]]
+            if value is not _missing:
+                return value
+        elif self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+    has_key = __contains__
+
+    def iteritems(self):
+        for i,value in enumerate(self._values):
+            if value is not _missing:
+                yield FIELDS[i], value
+        if self._extra:
+            for item in self._extra.iteritems():
+                yield item
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return [key for key,value in self.iteritems()]
+
+    def values(self):
+        return [value for key,value in self.iteritems()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if not isinstance(other, (Mapping, CompactStation)):
+            return NotImplemented
+        return dict(self.iteritems()) == dict(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    # Equal to the dicts it was made from, which are unhashable too
+    __hash__ = None
+
+    def __reduce__(self):
+        return CompactStation, (dict(self.iteritems()),)
+
+    geo = Station.geo
+
+    def __repr__(self):
+        return '<CompactStation %s>'%self.id
+
+def station_pack():
+    """PackFile of every station of the last refresh, None before the first
+
+    Reading one station from it is one seek::
+
+        pack = station_pack()
+        Station(pack.get('KALB'))
+    """
+    try:
+        return PackFile(os.path.join(conf.data_root, PACK))
+    except IOError:
+        return None
+
+def stations(force_parse=False, compact=False):
+    """Every station, as CompactStation records when compact
+
+    Streamed from the pack of the last refresh, from the store when there
+    is none yet and from a fresh parse when the store is empty too.
+    """
+    found = False
+    if not force_parse:
+        pack = station_pack()
+        if pack is not None:
+            records = iter(pack)
+        else:
+            records = conf.scan('observations')
+        try:
+            for id,station in records:
+                found = True
+                if compact:
+                    yield CompactStation(station)
+                else:
+                    yield Station(station)
+        finally:
+            if pack is not None:
+                pack.close()
+    if not found:
         for station in parse():
-            yield station
-    else:
-        for file in files:
-            yield Station(conf.load('observations',file))
+            if compact:
+                yield CompactStation(station)
+            else:
+                yield station
     
+def station_index():
+    """SpatialIndex of the stored stations' points, keyed by station id
+
+    Every cron() and hotlist poll saves a new one with the stations it
+    wrote. A data root stored before the index existed gets one built from
+    stations() on first use.
+    """
+    if conf.resource_exists('spatial', 'observations'):
+        return conf.load('spatial', 'observations')
+    index = SpatialIndex([(station.id,) + station.point
+                          for station in stations()])
+    conf.dump('spatial', index, 'observations')
+    return index
+
+def nearest_stations(lat, lon, k=1):
+    """[(Station, km), ...] of the k stations closest to lat, lon"""
+    return [(Station(id), km) for id,km in
+            station_index().k_nearest(lat, lon, k)]
+
+def stations_within(lat, lon, km):
+    """[(Station, km), ...] of the stations within km of lat, lon"""
+    return [(Station(id), distance) for id,distance in
+            station_index().within(lat, lon, km)]
+
 def location2station(location):
     """
     Translate full location into Station tuple by closest match
@@ -140,13 +772,57 @@ def location2station(location):
     "State St, Troy, NY", "2nd st & State St, Troy, NY" & "7 State St, Troy, NY"
     """
     point = Location(location).point
-    best,result = 99999999,None
+    found = station_index().nearest(*point)
+    if found:
+        return Station(found[0])
+
+def station_history():
+    """History of every station's readings, under <data_root>/observations/
+    history and kept for the observations.history_days option (30 days)"""
+    return History(os.path.join(conf.data_root, 'observations', 'history'),
+                   HISTORY_FIELDS,
+                   conf.getint('observations', 'history_days', 30) * 86400)
+
+def _seconds(when):
+    if isinstance(when, datetime):
+        return calendar.timegm(when.utctimetuple())
+    return when
+
+def history(station_id, start=None, end=None, fields=None):
+    """Readings of a station taken from start up to end (datetimes, naive
+    ones in UTC, or seconds since the epoch) as arrays of doubles
+
+    Returns {'time': array, field: array, ...} for fields (default
+    HISTORY_FIELDS); missing values are NaN.
+    """
+    return station_history().read(station_id, _seconds(start),
+                                  _seconds(end), fields)
+
+def snapshot():
+    """Columns of the stored stations for vectorized queries (needs NumPy)
+
+    Numeric fields (NUMERIC_FIELDS) are masked float arrays, station_id,
+    state, weather and wind_dir categorical columns::
+
+        hot = snapshot().filter(temp_f__gt=100, state='TX')
+        zip(hot['station_id'], hot['temp_f'])
+
+    Saved with the station pack by each refresh, and so as current as
+    station_index(). When NumPy was missing at the last refresh, the first
+    call makes up for it with a pass over every stored station.
+    """
+    if conf.resource_exists('columns', 'observations'):
+        return conf.load('columns', 'observations')
+    builder = ColumnBuilder(NUMERIC_FIELDS, CATEGORICAL_FIELDS)
     for station in stations():
-        tpoint = station.point
-        distance = ((tpoint[0]-point[0])**2 + (tpoint[1]-point[1])**2)**.5
-        if distance < best:
-            best,result = distance,station
-    return result
+        builder.add(station, state=station.state)
+    columns = builder.build()
+    conf.dump('columns', columns, 'observations')
+    return columns
+
+def stations_where(**lookups):
+    """Stations matching lookups on the snapshot, eg. temp_f__gt=100"""
+    return [Station(id) for id in snapshot().filter(**lookups)['station_id']]
 
 def test(unit):
     for station in stations(True):
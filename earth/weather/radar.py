@@ -1,31 +1,27 @@
 import re
 import os
-from urllib import urlopen
 from earth.core.config import conf
 from earth.core import RequestError
+from earth.core.transport import transport
 from datetime import datetime
-from dateutil.tz import tzutc
+from earth.core import require
 
 RADAR_TYPES = ('N0R', 'N0S', 'N0V', 'N1P', 'NCR', 'NTP', 'N0Z')
 URL = "http://radar.weather.gov/ridge/RadarImg/%s"
     
-def get_radar_report(station_id, radar_id='N0R'):
+def radar_urls(station_id, radar_id='N0R'):
+    """Returns the urls of the world file and of the image listing"""
+    return (URL % ("%s/%s_%s_0.gfw" % (radar_id.upper(), station_id.upper(), radar_id.upper())),
+            URL % ("%s/%s/" % (radar_id.upper(), station_id.upper())))
+
+def parse_radar_report(world_file, listing, url):
+    """Parses the world file and image listing (at url) of a radar"""
+    tzutc = require('dateutil.tz').tzutc
     data = {}
-    url = URL % ("%s/%s_%s_0.gfw" % (radar_id.upper(), station_id.upper(), radar_id.upper()))
-    try:
-        data['world_file'] = map(lambda x: float(x.strip()),urlopen(url).readlines())
-    except IOError, e:
-        conf.log('warning','RequestError: %s'%e)
-        raise RequestError, e
-    url = URL % ("%s/%s/" % (radar_id.upper(), station_id.upper()))
-    try:
-        domreader = urlopen(url)
-    except IOError, e:
-        conf.log('warning','RequestError: %s'%e)
-        raise RequestError, e
+    data['world_file'] = map(lambda x: float(x.strip()),world_file.splitlines())
     data['file_list'] = []
     r = re.compile(r'.*<img src="/icons/image2.gif".*<a href="(.*?)">.*')
-    for x in domreader:
+    for x in listing.splitlines():
         search = r.search(x)
         if search:
             filename = search.groups()[0]
@@ -38,15 +34,22 @@ def get_radar_report(station_id, radar_id='N0R'):
             })
     return data
 
+def get_radar_report(station_id, radar_id='N0R'):
+    pages = []
+    for url in radar_urls(station_id, radar_id):
+        try:
+            pages.append(transport.open(url).read())
+        except IOError, e:
+            conf.log('warning','RequestError: %s'%e)
+            raise RequestError, e
+    return parse_radar_report(pages[0], pages[1], url)
+
 class RadarStation(dict):
     def __init__(self, station_id, radar_id):
         assert radar_id in RADAR_TYPES, 'Unknown radar type %s'%radar_id
         data = {'station_id':station_id,'radar_id':radar_id}
-        if conf.resource_exists('radar','%s.%s'%(station_id,radar_id)):
-            data.update(conf.load('radar','%s.%s'%(station_id,radar_id)))
-        else:
-            data.update(get_radar_report(station_id, radar_id))
-            conf.dump('radar', dict(data), '%s.%s'%(station_id,radar_id))
+        data.update(conf.cached('radar', '%s.%s'%(station_id,radar_id),
+                                lambda: get_radar_report(station_id, radar_id)))
         dict.__init__(self, data)
                       
 def test(unit):
@@ -3,25 +3,38 @@ import time
 import urllib
 from datetime import datetime, timedelta
 
-try:
-    from lxml import objectify
-except ImportError:
-    raise ImportError, "Missing dependency: lxml"
-
-try:
-    from SOAPpy import WSDL
-except ImportError:
-    raise ImportError, "Missing dependency: SOAPpy"
-
 from earth.core import *
+from earth.core.transport import transport
 
 API_KEY = ''
 
-def _requester(name, data):
+def api_url(name, data):
     data.update({'ACode': API_KEY})
     url_data = urllib.urlencode(data)
-    url = "http://%s.api.wxbug.net/%s.aspx?%s" % (API_KEY, name, url_data)
-    return HTTPRequest().open(url).read()
+    return "http://%s.api.wxbug.net/%s.aspx?%s" % (API_KEY, name, url_data)
+
+def _requester(name, data):
+    return transport.open(api_url(name, data)).read()
+
+def _fromstring(xml_string):
+    return require('lxml.objectify').fromstring(xml_string)
+
+def _api(proc):
+    """Turns a function returning the (name, data) of a request into an API
+    call whose parsed response is processed by proc.
+
+    The call also gets .url(*args) and .parse(xml_string) for callers that
+    do their own I/O, like earth.aio.
+    """
+    def decorator(request):
+        def call(*args, **kwargs):
+            return proc(_fromstring(_requester(*request(*args, **kwargs))))
+        call.__name__ = request.__name__
+        call.__doc__ = request.__doc__
+        call.url = lambda *args, **kwargs: api_url(*request(*args, **kwargs))
+        call.parse = lambda xml_string: proc(_fromstring(xml_string))
+        return call
+    return decorator
 
 def _ns(obj, search):
     """Makes searching via namespace slightly easier."""
@@ -54,10 +67,7 @@ def _proc_children(ob, ob_dict):
     return ob_dict
 
 # Locations ----------
-def GetLocationList(search):
-    name = 'getLocationsXML'
-    data = {'SearchString': search}
-    xmldom = objectify.fromstring(_requester(name, data))
+def _proc_locations(xmldom):
     return [{'cityname': l.attrib.get('cityname'),
             'statename': l.attrib.get('statename'),
             'countryname': l.attrib.get('countryname'),
@@ -65,6 +75,12 @@ def GetLocationList(search):
             'citycode': l.attrib.get('citycode'),
             'citytype': l.attrib.get('citytype')}
             for l in xmldom.locations.getchildren()]
+
+@_api(_proc_locations)
+def GetLocationList(search):
+    name = 'getLocationsXML'
+    data = {'SearchString': search}
+    return name, data
     
 # Stations ----------
 def _process_station_list(xmldom):
@@ -80,20 +96,23 @@ def _process_station_list(xmldom):
              'lat': s.attrib.get('latitude'),
              'lon': s.attrib.get('longitude')} for s in stations]    
 
+@_api(_process_station_list)
 def GetStationListByCityCode(search):
     name = 'getStationsXML'
     data = {'cityCode': search}
-    return _process_station_list(objectify.fromstring(_requester(name, data)))
+    return name, data
 
+@_api(_process_station_list)
 def GetStationListByUSZipCode(zip_code):
     name = 'getStationsXML'
     data = {'zipCode': zip_code}
-    return _process_station_list(objectify.fromstring(_requester(name, data)))
+    return name, data
 
+@_api(_process_station_list)
 def GetUSWorldCityByLatLong(lat, lon):
     name = 'getStationsXML'
     data = {'lat': lat, 'lon': lon}
-    return _process_station_list(objectify.fromstring(_requester(name, data)))
+    return name, data
 
 # Live Weather ----------
 def _proc_live_weather(xmldom):
@@ -104,11 +123,13 @@ def _proc_live_weather(xmldom):
         weather_list.append(_proc_children(w.ob, w_dict))
     return weather_list
     
+@_api(_proc_live_weather)
 def GetLiveWeatherByCityCode(city_code, unit_type=0):
     name = 'getLiveWeatherRSS'
     data = {'cityCode': city_code, 'UnitType': unit_type}
-    return _proc_live_weather(objectify.fromstring(_requester(name, data)))
+    return name, data
 
+@_api(_proc_live_weather)
 def GetLiveWeatherByStationID(station_ids, unit_type=0):
     """Returns weather data for one more more stations.
     
@@ -119,17 +140,19 @@ def GetLiveWeatherByStationID(station_ids, unit_type=0):
     """
     name = 'getLiveWeatherRSS'
     data = {'stationid': ','.join(station_ids), 'UnitType': unit_type}
-    return _proc_live_weather(objectify.fromstring(_requester(name, data)))
+    return name, data
 
+@_api(_proc_live_weather)
 def GetLiveWeatherByUSZipCode(zip_code, unit_type=0):
     name = 'getLiveWeatherRSS'
     data = {'zipCode': zip_code, 'UnitType': unit_type}
-    return _proc_live_weather(objectify.fromstring(_requester(name, data)))
+    return name, data
 
+@_api(_proc_live_weather)
 def GetLiveWeatherByLatLon(lat, lon, unit_type=0):
     name = 'getLiveWeatherRSS'
     data = {'lat': lat, 'lon': lon, 'UnitType': unit_type}
-    return _proc_live_weather(objectify.fromstring(_requester(name, data)))
+    return name, data
 
 # Compact Live Weather ----------
 def _proc_clive_weather(xmldom):
@@ -140,20 +163,23 @@ def _proc_clive_weather(xmldom):
         weather_list.append(_proc_children(w, w_dict))
     return weather_list
         
+@_api(_proc_clive_weather)
 def GetLiveCompactWeatherByCityCode(length, city_code, unit_type=0):
     name = 'getLiveCompactWeatherRSS'
     data = {'cityCode': city_code, 'UnitType': unit_type}
-    return _proc_clive_weather(objectify.fromstring(_requester(name, data)))
+    return name, data
 
+@_api(_proc_clive_weather)
 def GetLiveCompactWeatherByStationID(station_id, unit_type=0):
     name = 'getLiveCompactWeatherRSS'
     data = {'stationid': station_id, 'UnitType': unit_type}
-    return _proc_clive_weather(objectify.fromstring(_requester(name, data)))
+    return name, data
 
+@_api(_proc_clive_weather)
 def GetLiveCompactWeatherByUSZipCode(zip_code, unit_type=0):
     name = 'getLiveCompactWeatherRSS'
     data = {'zipCode': zip_code, 'UnitType': unit_type}
-    return _proc_clive_weather(objectify.fromstring(_requester(name, data)))
+    return name, data
 
 # Alerts ----------
 def _proc_alerts(xmldom):
@@ -165,15 +191,17 @@ def _proc_alerts(xmldom):
         alert_list.append(_proc_children(a, a_dict))
     return alert_list
 
+@_api(_proc_alerts)
 def GetAlertsDataListByUSZipCode(zip_code, unit_type=0):
     name = 'getAlertsRSS'
     data = {'zipCode': zip_code, 'UnitType': unit_type}
-    return _proc_alerts(objectify.fromstring(_requester(name, data)))
+    return name, data
 
+@_api(_proc_alerts)
 def GetAlertsDataListByLatLon(lat, lon, unit_type=0):
     name = 'getAlertsRSS'
     data = {'lat': lat, 'lon': lon, 'UnitType': unit_type}
-    return _proc_alerts(objectify.fromstring(_requester(name, data)))
+    return name, data
 
 # Forecasts ----------
 def _proc_forecasts(xmldom):
@@ -186,20 +214,23 @@ def _proc_forecasts(xmldom):
         forecast_list.append(_proc_children(f, f_dict))
     return forecast_list
 
+@_api(_proc_forecasts)
 def GetForecastByCityCode(city_code, unit_type=0):
     name = 'getForecastRSS'
     data = {'cityCode': city_code, 'UnitType': unit_type}
-    return _proc_forecasts(objectify.fromstring(_requester(name, data)))
+    return name, data
 
+@_api(_proc_forecasts)
 def GetForecastByUSZipCode(zip_code, unit_type=0):
     name = 'getForecastRSS'
     data = {'zipCode': zip_code, 'UnitType': unit_type}
-    return _proc_forecasts(objectify.fromstring(_requester(name, data)))
+    return name, data
 
+@_api(_proc_forecasts)
 def GetForecastByLatLon(lat, lon, unit_type=0):
     name = 'getForecastRSS'
     data = {'lat': lat, 'lon': lon, 'UnitType': unit_type}
-    return _proc_forecasts(objectify.fromstring(_requester(name, data)))
+    return name, data
 
 # Cameras ----------
 def _proc_cameras(xmldom):
@@ -212,16 +243,18 @@ def _proc_cameras(xmldom):
         cam_list.append(a_dict)
     return cam_list
     
+@_api(_proc_cameras)
 def GetCameraListByUSZipCode(zip_code, unit_type=0):
     name = 'getCamerasXML'
     data = {'zipCode': zip_code, 'UnitType': unit_type}
-    return _proc_cameras(objectify.fromstring(_requester(name, data)))
+    return name, data
     
 
+@_api(_proc_cameras)
 def GetCameraListByLatLon(lat, lon, unit_type=0):
     name = 'getCamerasXML'
     data = {'lat': lat, 'lon': lon, 'UnitType': unit_type}
-    return _proc_cameras(objectify.fromstring(_requester(name, data)))
+    return name, data
 
 # Custom ----------
 # These methods are notoriously slow as they have to make a request
@@ -0,0 +1,293 @@
+"""Parser benchmarks over the recorded fixtures
+
+    python tests/bench.py               # every parser
+    python tests/bench.py quake sun     # only some of them
+    python tests/bench.py --record      # refresh the fixtures from upstream
+    python tests/bench.py --stations    # Station against CompactStation
+    python tests/bench.py --parallel 4  # all_xml.zip serially and by 4 workers
+
+Each benchmark runs in a fresh interpreter and reports the records parsed
+per second and the peak memory (maxrss) the parse added to the process.
+Parsers whose optional dependencies are missing are reported as skipped.
+"""
+import os
+import sys
+import time
+import gzip
+import zipfile
+import tempfile
+import resource
+import subprocess
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from earth.core import replay
+
+FIXTURES = os.path.join(ROOT, 'tests', 'fixtures')
+# Seconds each parser is repeated for
+MIN_TIME = 1.0
+# Copies of the observations fixture held at once by --stations
+STATION_COPIES = 50
+# Members of the zip --parallel parses, about as many as all_xml.zip has
+PARALLEL_MEMBERS = 2000
+# Recorded with a placeholder key, set a real one to --record
+WEATHERBUG_KEY = 'A0000000000'
+DWML_URL = ('http://www.weather.gov/forecasts/xml/sample_products/'
+            'browser_interface/ndfdXMLclient.php?'
+            'lat=38.99&lon=-77.01&product=glance')
+
+def sun():
+    from earth.sun import sun_report_request, parse_sun_report
+    url,data = sun_report_request(year=2009, st='MO', place='st louis',
+                                  report_type=0)
+    return [('POST', url, data)], lambda page: \
+        len(parse_sun_report(StringIO(page).readlines(), 2009))
+
+def quake():
+    from earth.quake import URL, iter_catalog
+    def parse(page):
+        count = 0
+        for event in iter_catalog(gzip.GzipFile(fileobj=StringIO(page))):
+            count += 1
+        return count
+    return [('GET', URL, None)], parse
+
+def observations():
+    from earth.weather.observations import URL, parse_observations
+    return [('GET', URL, None)], lambda page: \
+        len([x for x in parse_observations(StringIO(page))])
+
+def station():
+    from earth.weather.observations import STATION_URL, parse_station
+    return [('GET', STATION_URL % id, None) for id in ('KACF', 'KACX')], \
+        lambda *pages: len([parse_station(page) for page in pages])
+
+def cap_alert():
+    from earth.weather.alerts import CAP_URL, parse_cap_alert
+    def parse(page):
+        parse_cap_alert(page)
+        return 1
+    return [('GET', CAP_URL % 'ak', None)], parse
+
+def zone_alert():
+    from earth.weather.alerts import ZONE_URL, parse_zone_alert
+    def parse(page):
+        parse_zone_alert(page)
+        return 1
+    return [('GET', ZONE_URL % 'AKZ161', None)], parse
+
+def state_alert():
+    from earth.weather.alerts import STATE_URL, parse_state_alert
+    def parse(page):
+        parse_state_alert(page)
+        return 1
+    return [('GET', STATE_URL % 'ak', None)], parse
+
+def dwml():
+    from earth.weather.forecasts import Forecast
+    params = ('maxt', 'mint', 'sky', 'icons')
+    def parse(page):
+        # The SOAP client is not needed to process a DWML document
+        forecast = Forecast.__new__(Forecast)
+        locations = forecast._process_returned_xml(params, page)
+        return sum([len(values) for location in locations.values()
+                    for values in location['params'].values()])
+    return [('GET', DWML_URL, None)], parse
+
+def weatherbug():
+    from earth.weather import weatherbug
+    call = weatherbug.GetStationListByUSZipCode
+    # The fixture was recorded with WEATHERBUG_KEY, leave the user's key be
+    key,weatherbug.API_KEY = weatherbug.API_KEY, WEATHERBUG_KEY
+    try:
+        url = call.url('20001')
+    finally:
+        weatherbug.API_KEY = key
+    return [('GET', url, None)], lambda page: len(call.parse(page))
+
+def pollen():
+    from earth.air.pollen import BASE_URL, ARGS, parse_pollen_counts
+    return [('GET', BASE_URL + ARGS % 35, None)], lambda page: \
+        len(parse_pollen_counts(page))
+
+def uv():
+    from earth.air.uv import uv_index_url, parse_uv_index
+    def parse(page):
+        parse_uv_index(page)
+        return 1
+    return [('GET', uv_index_url(zipcode='12203'), None)], parse
+
+def radar():
+    from earth.weather.radar import radar_urls, parse_radar_report
+    urls = radar_urls('lwx', 'N0R')
+    return [('GET', url, None) for url in urls], lambda world, listing: \
+        len(parse_radar_report(world, listing, urls[1])['file_list'])
+
+BENCHMARKS = [('sun', sun), ('quake', quake), ('observations', observations),
+              ('station', station), ('cap_alert', cap_alert), ('zone_alert', zone_alert),
+              ('state_alert', state_alert), ('dwml', dwml),
+              ('weatherbug', weatherbug), ('pollen', pollen), ('uv', uv),
+              ('radar', radar)]
+
+def load(name):
+    """Returns (parse, payloads) of a benchmark
+
+    parse(*payloads) returns the number of records parsed. It raises
+    ImportError when an optional dependency of the parser is missing.
+    """
+    requests,parse = dict(BENCHMARKS)[name]()
+    fixtures = replay.Fixtures(FIXTURES)
+    return parse, [fixtures.body(*request) for request in requests]
+
+def run(name):
+    """Times one parser in this process: (records/s, records, peak KB)
+
+    Alerts count as one record per document.
+    """
+    parse,payloads = load(name)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    parse(*payloads)
+    records,count = 0,0
+    start = time.time()
+    while time.time() - start < MIN_TIME:
+        records += parse(*payloads)
+        count += 1
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    return records / elapsed, records / count, peak
+
+def stations(kind):
+    """Memory and access cost of one station record type in this process
+
+    Returns (bytes per station, microseconds per access) where an access
+    reads an observed value, the timestamp and the coordinates.
+    """
+    from earth.weather import observations
+    wrap = {'Station': lambda station: station,
+            'CompactStation': observations.CompactStation}[kind]
+    parse,(page,) = load('observations')
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    records = []
+    for i in range(STATION_COPIES):
+        records.extend([wrap(station) for station in
+                        observations.parse_observations(StringIO(page))])
+    size = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) \
+        * 1024.0 / len(records)
+    accesses = 0
+    start = time.time()
+    while time.time() - start < MIN_TIME:
+        for record in records:
+            record['temp_f'], record.timestamp, record.point
+        accesses += len(records)
+    return size, (time.time() - start) * 1e6 / accesses
+
+def parallel(workers):
+    """Stations of a full size all_xml.zip parsed and digested per second,
+    serially and by a pool of workers: (serial, parallel, parent)
+
+    parent is the rate the parent process alone could keep up, from its
+    CPU time, so the most the pool can reach with a CPU per worker.
+    """
+    from earth.weather import observations
+    parse,(page,) = load('observations')
+    source = zipfile.ZipFile(StringIO(page))
+    members = [(name, source.read(name))
+               for name in observations._station_names(source)]
+    fd,path = tempfile.mkstemp(suffix='.zip')
+    os.close(fd)
+    try:
+        zfile = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        for i in range(PARALLEL_MEMBERS):
+            name,data = members[i % len(members)]
+            zfile.writestr('%d_%s' % (i, name), data)
+        zfile.close()
+        def serial():
+            return len([station.digest for station in
+                        observations.parse_observations(path)])
+        cpu = []
+        def pooled():
+            start = time.clock()
+            count = len(list(observations.parse_parallel(path, workers,
+                                                         digests=True)))
+            cpu.append((count, time.clock() - start))
+            return count
+        serial,pooled = rate(serial), rate(pooled)
+        parent = sum([count for count,seconds in cpu]) / \
+            sum([seconds for count,seconds in cpu])
+        return serial, pooled, parent
+    finally:
+        os.remove(path)
+
+def rate(parse):
+    """Records per second of parse(), after a first run to warm up"""
+    parse()
+    records = 0
+    start = time.time()
+    while time.time() - start < MIN_TIME:
+        records += parse()
+    return records / (time.time() - start)
+
+def record():
+    """Fetches every benchmark request live, saving it over its fixture"""
+    from earth.core.transport import transport
+    replay.install(FIXTURES, True)
+    try:
+        for name,setup in BENCHMARKS:
+            requests,parse = setup()
+            for method,url,data in requests:
+                print '%s %s' % (method, url)
+                transport.open(url, data)
+    finally:
+        replay.uninstall()
+
+def main(args):
+    if args[:1] == ['--record']:
+        return record()
+    if args[:1] == ['--parallel']:
+        import multiprocessing
+        workers = int((args[1:] or [multiprocessing.cpu_count()])[0])
+        print '%d stations, %d CPUs' % (PARALLEL_MEMBERS,
+                                        multiprocessing.cpu_count())
+        print '%-14s %12s' % ('parse', 'stations/s')
+        serial,pooled,parent = parallel(workers)
+        print '%-14s %12.1f' % ('serial', serial)
+        print '%-14s %12.1f' % ('%d workers' % workers, pooled)
+        print '%-14s %12.1f' % ('parent limit', parent)
+        return
+    if args[:1] == ['--one-stations']:
+        print '%f %f' % stations(args[1])
+        return
+    if args[:1] == ['--stations']:
+        print '%-14s %9s %10s' % ('record', 'bytes', 'us/access')
+        for kind in ('Station', 'CompactStation'):
+            out = subprocess.Popen([sys.executable, __file__,
+                                    '--one-stations', kind],
+                                   stdout=subprocess.PIPE).communicate()[0]
+            size,cost = map(float, out.split())
+            print '%-14s %9d %10.2f' % (kind, size, cost)
+        return
+    if args[:1] == ['--one']:
+        try:
+            print '%f %d %d' % run(args[1])
+        except ImportError, e:
+            print 'skipped: %s' % e
+        return
+    names = args or [name for name,setup in BENCHMARKS]
+    print '%-14s %8s %12s %9s' % ('parser', 'records', 'records/s', 'peak KB')
+    for name in names:
+        proc = subprocess.Popen([sys.executable, __file__, '--one', name],
+                                stdout=subprocess.PIPE)
+        out = proc.communicate()[0].strip()
+        if proc.returncode or out.startswith('skipped'):
+            print '%-14s %s' % (name, out or 'failed')
+            continue
+        rate,records,peak = out.split()
+        print '%-14s %8s %12.1f %9s' % (name, records, float(rate), peak)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,6 +1,148 @@
 import unittest
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+# The earth package and bench, however the tests are run
+for path in (TESTS, os.path.dirname(TESTS)):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+# Seconds importing every module may take in a fresh interpreter
+IMPORT_BUDGET = 0.5
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.time()
+import earth.geo, earth.sun, earth.quake
+import earth.weather.observations, earth.weather.alerts, earth.weather.radar
+import earth.weather.forecasts, earth.weather.weatherbug
+import earth.air.uv, earth.air.pollen, earth.aio
+print time.time() - start
+print ' '.join([name for name in ('SOAPpy', 'lxml', 'dateutil')
+                if name in sys.modules])
+"""
+
+class ImportTests(unittest.TestCase):
+    def test_import(self):
+        """Importing earth is fast, touches no files and defers optional deps"""
+        home = tempfile.mkdtemp()
+        try:
+            env = dict(os.environ, HOME=home, APPDATA=home,
+                PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            proc = subprocess.Popen([sys.executable, '-c', IMPORT_SCRIPT],
+                cwd=home, env=env, stdout=subprocess.PIPE)
+            elapsed, loaded = proc.communicate()[0].split('\n')[:2]
+            self.assertEqual(proc.returncode, 0)
+            self.assertEqual(os.listdir(home), [])
+            self.assertEqual(loaded.split(), [])
+            self.assert_(float(elapsed) < IMPORT_BUDGET,
+                         'Importing earth took %ss' % elapsed)
+        finally:
+            shutil.rmtree(home)
 
 class EarthTests(unittest.TestCase):
+    def test_config(self):
+        from earth.core.config import test
+        test(self)
+        
+    def test_store(self):
+        from earth.core.store import test
+        test(self)
+        
+    def test_transport(self):
+        from earth.core.transport import test
+        test(self)
+        
+    def test_aio(self):
+        from earth.aio import test
+        test(self)
+
+    def test_spatial(self):
+        from earth.core.spatial import test
+        test(self)
+
+    def test_history(self):
+        from earth.core.history import test
+        test(self)
+
+    def test_pack(self):
+        from earth.core.pack import test
+        test(self)
+
+    def test_rules(self):
+        from earth.core.rules import test
+        test(self)
+
+    def test_columns(self):
+        from earth.core.columns import test
+        try:
+            test(self)
+        except ImportError:
+            # NumPy is optional
+            pass
+
+    def test_replay(self):
+        from earth.core.replay import test
+        test(self)
+
+    def test_fixtures(self):
+        """Every parser handles its recorded fixture"""
+        import bench
+        for name,setup in bench.BENCHMARKS:
+            parse,payloads = bench.load(name)
+            try:
+                self.assert_(parse(*payloads) > 0, name)
+            except ImportError:
+                # Optional dependency of this parser is not installed
+                continue
+
+    def test_parallel_observations(self):
+        """Parsing all_xml.zip in a process pool matches the serial parse"""
+        import bench
+        from earth.weather.observations import parse_observations, parse_parallel
+        parse,(page,) = bench.load('observations')
+        fd,path = tempfile.mkstemp(suffix='.zip')
+        try:
+            os.write(fd, page)
+            os.close(fd)
+            serial = [dict(s) for s in parse_observations(path)]
+            parallel = [dict(s) for s in parse_parallel(path, 3, 16)]
+            self.assertEqual(len(serial), 200)
+            self.assertEqual(serial, parallel)
+        finally:
+            os.remove(path)
+
+    def test_compact_station(self):
+        """CompactStation reads the same as the Station it was made from"""
+        import bench, pickle
+        from StringIO import StringIO
+        from earth.weather.observations import parse_observations, \
+            CompactStation
+        parse,(page,) = bench.load('observations')
+        for station in parse_observations(StringIO(page)):
+            station['extra_field'] = 'x'
+            record = station.compact()
+            self.assertEqual(sorted(record.items()), sorted(station.items()))
+            self.assertEqual(dict(record), station)
+            for name in ('id', 'timestamp', 'datetime', 'point', 'location',
+                         'icon', 'state', 'digest'):
+                self.assertEqual(getattr(record, name),
+                                 getattr(station, name))
+            self.assertEqual(record['temp_f'], station['temp_f'])
+            self.assert_('wind_gust_mph' not in record)
+            self.assertEqual(record.get('wind_gust_mph', 1), 1)
+            self.assertRaises(KeyError, lambda: record['wind_gust_mph'])
+            self.assertEqual(pickle.loads(pickle.dumps(record)), station)
+            self.assert_(isinstance(pickle.loads(pickle.dumps(record)),
+                                    CompactStation))
+            self.assertNotEqual(record, None)
+            self.assertNotEqual(record, 'station')
+            self.assertRaises(TypeError, hash, record)
+
     def test_geo(self):
         from earth.geo import test
         test(self)
@@ -37,6 +179,471 @@ class EarthTests(unittest.TestCase):
         from earth.air.uv import test
         test(self)
 
+class OfflineTests(unittest.TestCase):
+
+    """Runs against a temporary data root with upstream served from the
+    recorded fixtures"""
+
+    def setUp(self):
+        from ConfigParser import ConfigParser
+        from earth.core.config import conf
+        from earth.core import replay
+        self.root = tempfile.mkdtemp()
+        config = ConfigParser()
+        config.add_section('earth')
+        config.set('earth', 'data_root', self.root)
+        config.set('earth', 'log', 'logging.out')
+        self.saved = conf._conf, conf._store
+        conf._conf, conf._store = config, None
+        replay.install(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    'fixtures'))
+
+    def tearDown(self):
+        from earth.core.config import conf
+        from earth.core import replay
+        replay.uninstall()
+        if conf._store is not None:
+            conf._store.close()
+        conf._conf, conf._store = self.saved
+        shutil.rmtree(self.root)
+
+    def test_incremental_observations(self):
+        """Refreshes only write what changed and report it to subscribers"""
+        from earth.core.config import conf
+        from earth.weather import observations
+        received = []
+        observations.subscribe(received.append)
+        try:
+            first = observations.cron()
+            self.assertEqual(len(first.added), 200)
+            # Not modified upstream, then re-parsed without any change
+            self.assertEqual(len(observations.cron()), 0)
+            self.assertEqual(len(observations.cron(force=True)), 0)
+            digests = conf.load('digests', 'observations')
+            changed = sorted(digests)[0]
+            digests[changed] = 'stale'
+            digests['KGONE'] = 'gone'
+            conf.dump('digests', digests, 'observations')
+            conf.dump('observations', {'station_id': 'KGONE'}, 'KGONE')
+            changes = observations.cron(force=True)
+            self.assertEqual((changes.added, changes.updated, changes.removed),
+                             ([], [changed], ['KGONE']))
+            self.assert_(not conf.resource_exists('observations', 'KGONE'))
+            self.assertEqual(received, [first, changes])
+        finally:
+            observations.unsubscribe(received.append)
+
+    def test_observation_encodings(self):
+        """Each document is decoded as it declares, a malformed one is
+        skipped without losing the others"""
+        import zipfile
+        from StringIO import StringIO
+        from earth.weather import observations
+        members = [
+            ('KUTF.xml', '<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<current_observation><station_id>KUTF</station_id>'
+             '<location>Mayag\xc3\xbcez, PR</location>'
+             '</current_observation>'),
+            ('KBAD.xml', '<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+             '<current_observation><station_id>KBAD</station_id>'),
+            ('KLAT.xml', '<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+             '<current_observation><station_id>KLAT</station_id>'
+             '<location>Mayag\xfcez, PR</location>'
+             '</current_observation>'),
+            ('KUNK.xml', '<?xml version="1.0" encoding="X-NOPE"?>\n'
+             '<current_observation/>'),
+            ('KEND.xml', '<current_observation><station_id>KEND'
+             '</station_id></current_observation>'),
+        ]
+        f = StringIO()
+        zfile = zipfile.ZipFile(f, 'w')
+        for name,data in members:
+            zfile.writestr(name, data)
+        zfile.close()
+        f.seek(0)
+        stations = list(observations.parse_observations(f))
+        self.assertEqual([station.id for station in stations],
+                         ['KUTF', 'KLAT', 'KEND'])
+        self.assertEqual(stations[0]['location'], u'Mayag\xfcez, PR')
+        self.assertEqual(stations[1]['location'], u'Mayag\xfcez, PR')
+
+    def test_station_pack(self):
+        """stations() streams the pack written by the last refresh"""
+        from earth.core.config import conf
+        from earth.weather import observations
+        self.assertEqual(observations.station_pack(), None)
+        observations.cron()
+        stored = dict([(id, station) for id,station in
+                       conf.scan('observations')])
+        conf.scan = None
+        try:
+            streamed = dict([(station.id, dict(station)) for station in
+                             observations.stations()])
+        finally:
+            del conf.scan
+        self.assertEqual(len(streamed), 200)
+        self.assertEqual(streamed, stored)
+        pack = observations.station_pack()
+        try:
+            self.assertEqual(pack.get('KACF'), stored['KACF'])
+        finally:
+            pack.close()
+
+    def test_hotlist(self):
+        """Hotlist readings are stored unless older, and survive the bulk
+        refresh until it catches up"""
+        from earth.core.config import conf
+        from earth.weather import observations
+        observations.cron()
+        bulk = observations.Station('KACF')
+        other = observations.Station('KACX')
+        indexed = conf.store.fetched('spatial', 'observations')
+        changes = observations.poll_hotlist(['KACF', 'KACX', 'KNONE'], 3)
+        # The KACX fixture is an hour older than the bulk snapshot
+        self.assertEqual(changes.updated, ['KACF'])
+        station = observations.Station('KACF')
+        self.assertEqual(station['temp_f'], 99)
+        self.assertEqual(station.timestamp, bulk.timestamp + 3600)
+        # The snapshots are rebuilt with the new reading
+        self.assert_(conf.store.fetched('spatial', 'observations') > indexed)
+        self.assertEqual(observations.nearest_stations(*station.point)[0][0],
+                         station)
+        self.assertEqual(len(observations.station_index()), 200)
+        try:
+            self.assertEqual([s.id for s in
+                              observations.stations_where(temp_f__gte=99)],
+                             [s.id for s in observations.stations()
+                              if s.get('temp_f') >= 99])
+        except ImportError:
+            # NumPy is optional
+            pass
+        self.assertEqual(observations.Station('KACX'), other)
+        self.assertEqual(len(observations.poll_hotlist(['KACF'])), 0)
+        for refresh in range(2):
+            streamed = dict([(s.id, s) for s in observations.stations()])
+            self.assertEqual(len(streamed), 200)
+            self.assertEqual(streamed['KACF']['temp_f'], 99)
+            self.assertEqual(len(observations.cron(force=True)), 0)
+        self.assertEqual(list(observations.history('KACF')['time']),
+                         [bulk.timestamp, bulk.timestamp + 3600])
+
+    def test_watch(self):
+        """Rules are matched against the stations each refresh changed"""
+        from Queue import Queue
+        from earth.weather import observations
+        queue,hot = Queue(), []
+        rules = [observations.watch(queue, temp_f__gte=60, state='FL'),
+                 observations.watch(lambda rule, station: hot.append(station),
+                                    temp_f__gte=99)]
+        try:
+            observations.cron()
+            expected = sorted([station.id for station in
+                               observations.stations()
+                               if station.get('temp_f') >= 60 and
+                               station.state == 'FL'])
+            found = []
+            while not queue.empty():
+                rule,station = queue.get()
+                self.assert_(rule is rules[0])
+                found.append(station.id)
+            self.assert_(expected)
+            self.assertEqual(sorted(found), expected)
+            self.assertEqual(hot, [])
+            # Nothing changed, nothing to match
+            observations.cron(force=True)
+            self.assert_(queue.empty())
+            observations.poll_hotlist(['KACF'])
+            self.assertEqual([station.id for station in hot], ['KACF'])
+        finally:
+            for rule in rules:
+                observations.unwatch(rule)
+
+    def test_quake(self):
+        """The catalog is parsed straight from the gzip, chunk by chunk"""
+        import gzip
+        from earth import quake
+        quake.cron()
+        path = os.path.join(self.root, quake.URI)
+        # No uncompressed copy next to the download
+        self.assertEqual([name for name in os.listdir(os.path.dirname(path))
+                          if not name.endswith('.validators')],
+                         [os.path.basename(path)])
+        whole = quake.parse_catalog(gzip.open(path).read())
+        self.assertEqual(len(whole), 1500)
+        self.assertEqual(list(quake.iter_catalog(gzip.open(path), 100)),
+                         whole)
+        self.assertEqual(sorted([event.id for event in quake.events()]),
+                         sorted([event['id'] for event in whole]))
+
+    def test_quake_interrupted(self):
+        """A download that was never parsed is downloaded and parsed again"""
+        from earth import quake
+        quake.fetch()
+        self.assertEqual(len(quake.cron().new), 1500)
+        self.assertEqual(len(quake.cron()), 0)
+        get_quake_events = quake.get_quake_events
+        def broken():
+            raise ValueError('Malformed catalog')
+            yield
+        quake.get_quake_events = broken
+        try:
+            self.assertRaises(ValueError, quake.cron, True)
+        finally:
+            quake.get_quake_events = get_quake_events
+        self.assert_(quake.fetch())
+
+    def test_quake_query(self):
+        """query() finds what a scan of every event finds, loading only
+        the matches"""
+        from earth import quake
+        from earth.core.config import conf
+        from earth.core.spatial import haversine
+        quake.cron()
+        everything = list(quake.events())
+        times = sorted([event.timestamp for event in everything])
+        start,end = times[len(times) // 4], times[3 * len(times) // 4]
+        def inside(event, south, west, north, east):
+            lat,lon = event.location
+            if west > east:
+                return south <= lat <= north and not east < lon < west
+            return south <= lat <= north and west <= lon <= east
+        cases = [
+            (dict(center=(35.7, -117.5), radius=3000, min_magnitude=4),
+             lambda e: haversine(35.7, -117.5, *e.location) <= 3000 and
+                       e.magnitude >= 4),
+            (dict(center=(10, 179.5), radius=2500, start=start, end=end),
+             lambda e: haversine(10, 179.5, *e.location) <= 2500 and
+                       start <= e.timestamp < end),
+            (dict(center=(88, 0), radius=3500),
+             lambda e: haversine(88, 0, *e.location) <= 3500),
+            (dict(bbox=(-30, 150, 30, -150), min_magnitude=2.5),
+             lambda e: inside(e, -30, 150, 30, -150) and e.magnitude >= 2.5),
+            (dict(bbox=(0, -10, 45, 60), start=start),
+             lambda e: inside(e, 0, -10, 45, 60) and e.timestamp >= start),
+            (dict(end=start, min_magnitude=3),
+             lambda e: e.timestamp < start and e.magnitude >= 3),
+        ]
+        load = conf.load
+        loaded = []
+        def counting(app, id):
+            loaded.append(app)
+            return load(app, id)
+        conf.load = counting
+        try:
+            for kwargs,match in cases:
+                del loaded[:]
+                found = [event.id for event in quake.query(**kwargs)]
+                self.assertEqual(sorted(found),
+                                 sorted([e.id for e in everything if match(e)]),
+                                 kwargs)
+                self.assertEqual(loaded.count('earthquake'), len(found))
+                self.assertEqual([e.timestamp for e in quake.query(**kwargs)],
+                                 sorted([e.timestamp for e in everything
+                                         if match(e)]))
+        finally:
+            del conf.load
+        for kwargs,match in cases:
+            self.assert_(quake.query(**kwargs), kwargs)
+
+    def test_quake_versions(self):
+        """Only higher versions replace an event, and every run reports
+        what it added, revised and deleted"""
+        from earth import quake
+        from earth.core.config import conf
+        first = quake.cron()
+        self.assertEqual(len(first.new), 1500)
+        self.assertEqual(len(quake.cron(force=True)), 0)
+        catalog = [dict(event) for event in quake.get_quake_events()]
+        revised,stale,gone = [quake.Event(e) for e in catalog[:3]]
+        bumped = dict(revised, version=str(int(revised['version']) + 1),
+                      magnitude='7.1')
+        older = dict(stale, version='0', magnitude='9.9')
+        added = dict(catalog[3], id='new1', version='2')
+        new = quake.Event(added).key
+        catalog = [bumped, revised, older] + catalog[3:] + \
+            [added, dict(added, version='1', magnitude='1.0')]
+        get_quake_events = quake.get_quake_events
+        quake.get_quake_events = lambda: iter([dict(e) for e in catalog])
+        try:
+            changes = quake.cron(force=True)
+            self.assertEqual(changes.new, [new])
+            self.assertEqual(changes.revised, [revised.key])
+            self.assertEqual(changes.deleted, [gone.key])
+            self.assertEqual(conf.load('changes', 'earthquake').revised,
+                             [revised.key])
+            self.assertEqual(quake.Event(conf.load('earthquake',
+                             revised.key)).magnitude, 7.1)
+            self.assertEqual([e.version for e in quake.revisions(revised.key)],
+                             [revised['version']])
+            self.assertEqual(conf.load('earthquake', stale.key), stale)
+            self.assertEqual(conf.load('earthquake', new)['version'], '2')
+            self.assertEqual(conf.load('earthquake', gone.key), None)
+            self.assertEqual(len(list(quake.events())), 1500)
+            self.assertEqual(len(quake.cron(force=True)), 0)
+        finally:
+            quake.get_quake_events = get_quake_events
+
+    def test_quake_networks(self):
+        """Networks may reuse each other's ids, and the reports of one
+        earthquake by several networks are associated"""
+        from earth import quake
+        from earth.core.config import conf
+        conf.conf.add_section('earthquake')
+        conf.conf.set('earthquake', 'preferred_networks', 'us')
+        catalog = [dict(event) for event in quake.get_quake_events()]
+        first,second = catalog[0], catalog[1]
+        # The same id in another network, at another time and place
+        shared = dict(second, id=first['id'], version='1')
+        shared['network-code'] = first['network-code'] == 'ak' and 'nc' or 'ak'
+        # A regional report of the first earthquake, 8 s later and a few
+        # km away, and the national one
+        regional = dict(first, id='r1', latitude=str(float(first['latitude'])
+                                                      + .05))
+        regional['network-code'] = 'hv'
+        regional['second'] = str(float(first['second']) + 8)
+        national = dict(regional, id='n1', version='1')
+        national['network-code'] = 'us'
+        catalog = [first, regional, national] + catalog[2:] + [shared]
+        get_quake_events = quake.get_quake_events
+        quake.get_quake_events = lambda: iter([dict(e) for e in catalog])
+        try:
+            changes = quake.cron(force=True)
+        finally:
+            quake.get_quake_events = get_quake_events
+        first,shared,regional,national = [quake.Event(e) for e in
+                                          (first, shared, regional, national)]
+        self.assertEqual(first.id, shared.id)
+        self.assertNotEqual(first.key, shared.key)
+        self.assertEqual(len(changes.new), len(catalog))
+        self.assertEqual(conf.load('earthquake', first.key), first)
+        self.assertEqual(conf.load('earthquake', shared.key), shared)
+        self.assertEqual(len(list(quake.events())), len(catalog))
+        self.assertEqual(quake.associated(regional.key),
+                         [national.key] + sorted([first.key, regional.key]))
+        self.assertEqual(quake.associated(shared.key), [shared.key])
+        found = [event.key for event in quake.query()]
+        self.assertEqual(len(found), len(catalog) - 2)
+        self.assert_(national.key in found and shared.key in found)
+        self.assert_(first.key not in found and regional.key not in found)
+
+    def test_quake_catalog(self):
+        """The typed catalog and its EventViews agree with the events"""
+        from earth import quake
+        quake.cron()
+        events = dict([(event.key, event) for event in quake.events()])
+        typed = events.values()[0].typed()
+        self.assertEqual(typed['magnitude'], events.values()[0].magnitude)
+        self.assertEqual(typed['network_code'],
+                         events.values()[0].network_code)
+        try:
+            catalog = quake.catalog()
+        except ImportError:
+            # NumPy is optional
+            return
+        self.assertEqual(len(catalog), 1500)
+        for view in catalog:
+            event = events[view.key]
+            self.assertEqual(view.location, event.location)
+            self.assertEqual(view.magnitude, event.magnitude)
+            self.assertEqual(view.network_code, event.network_code)
+            self.assertEqual(view.datetime, event.datetime)
+            self.assertEqual(view.event(), event)
+        big = catalog.filter(magnitude__gte=4)
+        self.assertEqual(sorted([view.key for view in big]),
+                         sorted([key for key,event in events.items()
+                                 if event.magnitude >= 4]))
+        array = catalog.array()
+        self.assertEqual(list(array['magnitude']),
+                         [events[quake.event_key(network, id)].magnitude
+                          for network,id in zip(array['network_code'],
+                                                array['id'])])
+        self.assertEqual(str(catalog.datetimes.dtype), 'datetime64[us]')
+
+    def test_reverse_geocode(self):
+        """Points are labelled from the local gazetteer, Google is only
+        tried without one"""
+        import zipfile
+        from earth import geo, quake
+        from earth.core.config import conf
+        fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'fixtures')
+        path = os.path.join(fixtures, 'gazetteer.txt')
+        conf.conf.add_section('geo')
+        for option in ('sensor', 'country', 'lat_lon', 'span'):
+            conf.conf.set('geo', option, '')
+        conf.conf.set('geo', 'gazetteer', path)
+        location = geo.Location(42.66, -73.76)
+        self.assertEqual(location.address, 'Albany, NY, US')
+        self.assertEqual((location.locality, location.state,
+                          location.country_code), ('Albany', 'NY', 'US'))
+        self.assertEqual(location.point, (42.65258, -73.75623))
+        self.assert_(location['distance'] < 2)
+        labels = geo.reverse_geocode([42.7, -13.8, -13.8, 64.1],
+                                     [-73.7, -179.5, -179.5, -21.9])
+        self.assertEqual([label.locality for label in labels],
+                         ['Troy', 'Suva', 'Suva', u'Reykjav\xedk'])
+        zpath = os.path.join(self.root, 'cities.zip')
+        zfile = zipfile.ZipFile(zpath, 'w')
+        zfile.write(path, 'cities.txt')
+        zfile.close()
+        self.assertEqual(len(geo.Gazetteer.load(zpath)), 11)
+        quake.cron()
+        event = quake.events().next()
+        self.assert_(event.geo.address)
+        conf.conf.set('geo', 'gazetteer', os.path.join(self.root, 'missing'))
+        # Falls back to Google, which the fixtures do not have
+        self.assertRaises(TypeError, geo.Location, 42.66, -73.76)
+
+    def test_no_gazetteer(self):
+        """Without a gazetteer points are geocoded online, or from the
+        cache"""
+        from earth import geo, quake
+        from earth.core.config import conf
+        from earth.weather import observations
+        conf.conf.add_section('geo')
+        for option in ('sensor', 'country', 'lat_lon', 'span'):
+            conf.conf.set('geo', option, '')
+        conf.conf.set('geo', 'gazetteer', os.path.join(self.root, 'missing'))
+        conf.dump('geo', {'address': 'Albany, NY, USA'}, '42.66,-73.76')
+        self.assertEqual(geo.Location(42.66, -73.76).address,
+                         'Albany, NY, USA')
+        observations.cron()
+        station = observations.Station('KACF')
+        self.assertEqual(station.geo, None)
+        conf.dump('geo', {'address': 'Somewhere, FL, US'},
+                  ','.join(map(str, station.point)))
+        self.assertEqual(station.geo.address, 'Somewhere, FL, US')
+        quake.cron()
+        self.assertEqual(quake.events().next().geo, None)
+        # Nothing to download for a gazetteer of your own
+        self.assertEqual(geo.cron(), False)
+
+    def test_history(self):
+        """Every ingested reading is appended to its station's history"""
+        from earth.core.history import History
+        from earth.weather import observations
+        appended = []
+        append = History.append
+        def counting(self, key, timestamp, values):
+            appended.append(key)
+            return append(self, key, timestamp, values)
+        History.append = counting
+        try:
+            observations.cron()
+            self.assert_('KACF' in appended)
+            del appended[:]
+            # Nothing changed, nothing to append
+            observations.cron(force=True)
+            self.assertEqual(appended, [])
+        finally:
+            History.append = append
+        station = observations.Station('KACF')
+        data = observations.history('KACF', fields=['temp_f'])
+        self.assertEqual(list(data['time']), [station.timestamp])
+        self.assertEqual(list(data['temp_f']), [station['temp_f']])
+        self.assertEqual(len(observations.history('KACF',
+                             end=station.timestamp)['time']), 0)
+
 if __name__ == '__main__':
     unittest.main()
     